@@ -0,0 +1,297 @@
+import asyncio
+import os
+import time
+
+import serial
+
+from Devices.controller import TemperatureController
+from Devices.protocol import FRAME_END, ConnectionLost, ProtocolError, ResponseTimeout, STATUS_OK, parse_reply
+from utils.Events import EVENT_SAMPLE
+from utils.Records import state_flags
+
+
+class AsyncSerialTransport:
+    def __init__(self, port, baudrate=115200, max_frame=256):
+        """
+        Non-blocking serial transport for asyncio.
+
+        The port is opened and configured with pyserial, then its file descriptor is watched
+        by the event loop (`loop.add_reader`): bytes are read only when available, split into
+        frames and parsed as they arrive. Works with real serial ports and with ptys, which
+        makes it testable against a fake device. Needs an event loop with `add_reader`
+        (the default one on Linux and macOS, not the Windows proactor).
+
+        :param port: Path of the serial port or pty.
+        :param baudrate: Baud rate of the link.
+        :param max_frame: Longer lines are discarded as garbage.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.max_frame = max_frame
+        self.ser = None
+        self.loop = None
+        self.buffer = bytearray()
+        self.replies = None
+        self.error = None  # ConnectionLost once the port failed, see on_readable
+
+    async def open(self):
+        self.ser = serial.Serial(self.port, self.baudrate, stopbits=1, bytesize=8, parity=serial.PARITY_NONE,
+                                 timeout=0)
+        self.loop = asyncio.get_running_loop()
+        self.replies = asyncio.Queue()
+        self.error = None
+        self.loop.add_reader(self.ser.fileno(), self.on_readable)
+
+    def close(self):
+        if self.ser:
+            self.loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+
+    def on_readable(self):
+        """
+        Called by the event loop when the port has bytes to read, queues every complete reply.
+        """
+        try:
+            chunk = os.read(self.ser.fileno(), 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.lost(e)
+            return
+        if not chunk:
+            self.lost("end of file")  # Hung up, the port would stay readable forever
+            return
+        self.buffer += chunk
+
+        while True:
+            index = self.buffer.find(FRAME_END)
+            if index < 0:
+                break
+            self.replies.put_nowait(parse_reply(self.buffer, 0, index))
+            del self.buffer[:index + len(FRAME_END)]
+
+        if len(self.buffer) > self.max_frame:
+            self.buffer.clear()  # No terminator in sight, drop the garbage and resync
+
+    def lost(self, reason):
+        """
+        Stops watching a port that failed and fails the reply being awaited, instead of letting
+        the event loop call `on_readable` in a loop and the reader wait for its timeout.
+        """
+        self.loop.remove_reader(self.ser.fileno())
+        self.error = ConnectionLost(f"Lost the connection to {self.port}: {reason}")
+        self.replies.put_nowait(self.error)
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        try:
+            self.ser.write(data)
+        except serial.SerialException as e:
+            self.lost(e)
+            raise self.error
+
+    async def read_reply(self, timeout):
+        """
+        Waits for the next reply.
+
+        :raises ResponseTimeout: When no complete frame arrived before the deadline.
+        :raises ConnectionLost: When the port failed.
+        """
+        if self.error:
+            raise self.error
+        try:
+            reply = await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            raise ResponseTimeout(f"No reply from the controller within {timeout} s")
+        if isinstance(reply, ConnectionLost):
+            raise reply
+        return reply
+
+    def resync(self):
+        """
+        Drops any partial or late reply so the next command starts on a clean frame boundary.
+        """
+        self.ser.reset_input_buffer()
+        self.buffer.clear()
+        while not self.replies.empty():
+            self.replies.get_nowait()
+
+
+class AsyncTemperatureController(TemperatureController):
+    def __init__(self, port, **options):
+        """
+        TemperatureController running on an asyncio event loop instead of a thread.
+
+        Register reads and writes, autotune progress polling and the cycle state machine are
+        coroutines, so many controllers and the logging pipeline can share one event loop.
+        The cycle and autotune decisions are the same as the threaded controller's
+        (`cycle_step`, `autotune_step`), only the I/O differs.
+
+        Accepts the same options as TemperatureController.
+        """
+        super().__init__(port, **options)
+        self.transport = AsyncSerialTransport(port, self.baudrate)
+        self.lock = asyncio.Lock()
+        self.io_lock = asyncio.Lock()  # One command burst on the wire at a time
+        self.engine_task = None
+
+    async def connection(self):
+        await self.transport.open()
+
+    def start_engine_thread(self):
+        """
+        Starts the engine as a task of the running event loop (must be called from it).
+        """
+        self.engine_running = True
+        if not self.managed and (self.engine_task is None or self.engine_task.done()):
+            self.engine_task = asyncio.get_running_loop().create_task(self.engine())
+
+    async def engine(self):
+        self.scheduler.reset()
+        while self.engine_running:
+            await self.scheduler.wait_async()
+            await self.tick()
+
+    async def setup(self):
+        async with self.lock:
+            try:
+                await self.start_fan()
+                await self.read_pid_fc()
+            except ProtocolError as e:
+                self.status_callback = f"Controller error: {e}"
+                print(self.status_callback)
+                self.engine_running = False
+                return False
+        self.first_run = False
+        return True
+
+    async def tick(self):
+        if self.first_run and not await self.setup():
+            return
+
+        async with self.lock:
+            try:
+                await self.read_sensors()
+
+                if self.start_autotune:
+                    await self.start_autotune_fc()
+                if self.autotune_started:
+                    await self.read_autotune_progress()
+
+                if self.read_pid_values:
+                    await self.read_pid_fc()
+
+                if self.start_cycle:
+                    await self.cycle_basculement()
+
+                if self.cycle_mode:
+                    await self.cycle_basculement()
+            except ConnectionLost as e:
+                self.status_callback = f"Controller error: {e}"
+                print(self.status_callback)
+                self.engine_running = False  # Every command would fail the same way
+                return
+            except ProtocolError as e:
+                self.status_callback = f"Controller error: {e}"
+                print(self.status_callback)
+                return
+
+        timestamp = time.time()
+        self.valkey_log.log(self.r68_output, self.r65_output, timestamp=timestamp, device=self.device_id,
+                            state=state_flags(self.cycle_mode, self.switchover_callback, self.autotune_started))
+        self.publish(EVENT_SAMPLE, (timestamp, self.r68_output, self.r65_output))
+
+    async def read_sensors(self):
+        values = await self.read_registers([68, 65])
+        self.r68_output = values.get(68)
+        self.r65_output = values.get(65)
+
+    async def read_registers(self, registers):
+        return await self.transact("".join(f"$REG {register}\r\n" for register in registers), registers)
+
+    async def write_registers(self, values):
+        return await self.transact("".join(f"$REG {register}={value}\r\n" for register, value in values.items()),
+                                   list(values))
+
+    async def write_register(self, register, value):
+        return (await self.write_registers({register: value}))[register]
+
+    async def transact(self, commands, registers):
+        """
+        Same as TemperatureController.transact, awaiting the replies instead of blocking.
+        """
+        data = commands.encode()
+        async with self.io_lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.transport.write(data)
+                    values = dict.fromkeys(registers)
+                    for _ in registers:
+                        reply = await self.transport.read_reply(self.response_timeout)
+                        if reply.status == STATUS_OK and reply.register in values:
+                            values[reply.register] = reply.value
+                    return values
+                except ResponseTimeout:
+                    self.serial_retries += 1
+                    self.transport.resync()
+        raise ResponseTimeout(f"No reply from the controller on {self.port} after {self.retries + 1} attempts")
+
+    async def shut_down(self):
+        try:
+            ack = await self.write_register(2, 0)
+        except ProtocolError as e:
+            print(f"Error shutting down the controller: {e}")
+            return False
+        if ack == 0:
+            self.engine_running = False
+            return True
+
+    async def read_autotune_progress(self):
+        reg_value = (await self.read_registers([1]))[1]
+        if reg_value is not None and self.autotune_step(int(reg_value)):
+            await self.write_register(2, 0)
+            await self.shut_down()
+
+    async def start_autotune_fc(self):
+        if await self.write_register(2, 4) == 4:
+            self.start_autotune = False
+            self.autotune_started = True
+
+    async def read_pid_fc(self):
+        self.publish_pid(await self.read_registers([5, 6, 7]))
+        if self.engine_running:
+            self.read_pid_values = False
+
+    async def write_pid_values(self):
+        async with self.lock:
+            await self.write_registers({5: self.new_p_value, 6: self.new_i_value, 7: self.new_d_value})
+        if self.engine_running:
+            self.read_pid_values = True
+        else:
+            await self.read_pid_fc()
+
+    async def cycle_basculement(self):
+        writes, finished = self.cycle_step()
+        self.pending_writes.update(writes)
+        if self.pending_writes:
+            await self.write_registers(self.pending_writes)
+            self.pending_writes = {}
+        if finished:
+            await self.shut_down()
+
+    async def start_fan(self):
+        await self.write_registers({39: 1, 63: 2})
+
+    async def close(self):
+        """
+        Stops the engine task, closes the port and flushes the samples still waiting to be logged.
+        """
+        self.engine_running = False
+        if self.engine_task:
+            await self.engine_task
+        self.transport.close()
+        if not self.owns_valkey_log:
+            return True
+        return await asyncio.to_thread(self.valkey_log.close)
@@ -1,27 +1,53 @@
 import threading
-import serial
 import time
-import re
-from utils.ValkeyFuncs import ValkeyLog
+import serial
+from Devices.profile import ProfileRun, compile_profile, two_setpoint_recipe
+from Devices.protocol import FrameReader, ProtocolError, ResponseTimeout, STATUS_OK
+from utils.Events import EVENT_PID, EVENT_SAMPLE, EVENT_STATUS
+from utils.Metrics import metrics
+from utils.Records import state_flags
+from utils.ValkeyFuncs import ValkeyLog, WriteBehindLog
+from utils.Scheduler import TickScheduler
 
 
 class TemperatureController:
-    def __init__(self, port):
+    def __init__(self, port, poll_rate=1.0, response_timeout=0.5, retries=2, device_id=None, scheduler=None,
+                 valkey_log=None, events=None):
         """
         Initializes the TemperatureController with the specified serial port.
 
         :param port: The serial port to connect to the controller.
+        :param poll_rate: Number of engine ticks (sensor reads and logged samples) per second.
+        :param response_timeout: Maximum time to wait for each reply, in seconds.
+        :param retries: Number of times a command is resent, after a resync, when a reply times out.
+        :param device_id: ID the logged samples are tagged with, None to leave them untagged.
+        :param scheduler: Shared TickScheduler of a ControllerManager. When given, the controller
+            has no engine thread of its own and the manager calls `tick` on each deadline.
+        :param valkey_log: Shared WriteBehindLog, a private one is created when None.
+        :param events: Optional EventBus the samples, status changes and PID gains are published
+            to as they happen, for the GUI.
         """
         self.port = port
+        self.device_id = device_id
+        self.events = events
         self.baudrate = 115200
         self.ser = None
-        self.lock = threading.Lock()
+        self.reader = None
+        self.response_timeout = response_timeout
+        self.retries = retries
+        self.serial_retries = 0  # Commands resent after a timeout since the start
+        # Reentrant: the autotune and cycle logic call shut_down while the engine holds the lock
+        self.lock = threading.RLock()
 
-        self.valkey_log = ValkeyLog()
+        # Samples are queued and written by a background thread, Valkey never stalls the engine
+        self.owns_valkey_log = valkey_log is None
+        self.valkey_log = WriteBehindLog(ValkeyLog()) if valkey_log is None else valkey_log
 
         self.engine_running = False
         self.engine_thread = None
         self.first_run = True
+        self.managed = scheduler is not None
+        self.scheduler = TickScheduler(poll_rate, name=device_id or port) if scheduler is None else scheduler
 
         self.r68_output = ""
         self.r65_output = ""
@@ -46,20 +72,51 @@ class TemperatureController:
         self.percentage_threshold = 0
         self.time_btw_switchover = 0
         self.wanted_nb_cycle = 0
-        self.switchover_number = 0
         self.current_nb_cycle = 0
-        self.switchover_callback = 0
+        self.switchover_callback = 0  # Phase of the running profile step, logged in the state flags
+        self.recipe = None  # Segments run by the next cycle, the high/low cycle when None (see Devices.profile)
+        self.profile = None  # ProfileRun of the running cycle
+        self.pending_writes = {}  # Setpoint writes of the cycle not acknowledged yet
+
+        self.status = None
+
+    @property
+    def status_callback(self):
+        return self.status
 
-        self.status_callback = None
+    @status_callback.setter
+    def status_callback(self, message):
+        # Published only when it changes, the autotune repeats its progress message every tick
+        if message != self.status:
+            self.status = message
+            self.publish(EVENT_STATUS, message)
+
+    def publish(self, kind, payload):
+        if self.events is not None:
+            self.events.publish(kind, self.device_id, payload)
+
+    def publish_pid(self, values):
+        """
+        Stores the PID gains read from registers 5, 6 and 7 and publishes them when they changed.
+        """
+        gains = (values.get(5), values.get(6), values.get(7))
+        if gains != (self.r5_gain_value, self.r6_gain_value, self.r7_gain_value):
+            self.r5_gain_value, self.r6_gain_value, self.r7_gain_value = gains
+            self.publish(EVENT_PID, gains)
 
     def connection(self):
         """
         Establishes a connection to the temperature controller via the specified serial port.
         """
-        self.ser = serial.Serial(self.port, self.baudrate, stopbits=1, bytesize=8, parity=serial.PARITY_NONE)
+        # Short read timeout, the deadline of each reply is enforced by the FrameReader
+        self.ser = serial.Serial(self.port, self.baudrate, stopbits=1, bytesize=8, parity=serial.PARITY_NONE,
+                                 timeout=0.05)
+        self.reader = FrameReader(self.ser)
 
     def start_engine_thread(self):
         self.engine_running = True
+        if self.managed:
+            return  # The ControllerManager ticks every running controller
         self.engine_thread = threading.Thread(target=self.engine, daemon=False)
         self.engine_thread.start()
 
@@ -67,107 +124,199 @@ class TemperatureController:
         """
         Main engine loop that handles sensor reading, controller logic, and logging.
         """
-        if self.first_run:
-            self.start_fan()
-            self.read_pid_fc()
-            self.first_run = False
-        else:
-            while self.engine_running:
-                t_start = time.time()
-                with self.lock:  # Acquire mutex to avoid race condition
-                    self.read_sensors()
-
-                    if self.start_autotune:
-                        self.start_autotune_fc()
-                    if self.autotune_started:
-                        self.read_autotune_progress()
-
-                    if self.read_pid_values:
-                        self.read_pid_fc()
-
-                    if self.start_cycle:
-                        self.cycle_basculement()
-
-                    if self.cycle_mode:
-                        self.cycle_basculement()
+        self.scheduler.reset()
+        while self.engine_running:
+            self.scheduler.wait()  # Absolute monotonic deadlines, overruns skip ticks instead of drifting
+            self.tick()
 
-                    self.valkey_log.log(self.r68_output, self.r65_output)
-
-                t_end = time.time()
-                elapsed_time = t_end - t_start
-                sleep_time = 1 - elapsed_time
+    def setup(self):
+        """
+        Starts the fan and reads the PID gains, once before the first tick.
 
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
+        :returns: False when the controller didn't answer, the engine is then stopped.
+        """
+        with self.lock:
+            try:
+                self.start_fan()
+                self.read_pid_fc()
+            except ProtocolError as e:
+                self.status_callback = f"Controller error: {e}"
+                print(self.status_callback)
+                self.engine_running = False
+                return False
+        self.first_run = False
+        return True
+
+    def tick(self):
+        """
+        One engine cycle: reads the sensors, runs the autotune and cycle logic, and queues
+        the sample for logging.
+        """
+        if self.first_run and not self.setup():
+            return
+
+        device = self.device_id or self.port
+        with metrics.timer("controller_tick_seconds", device=device):
+            # Acquire mutex to avoid race condition
+            with metrics.locked(self.lock, "controller_lock", device=device):
+                try:
+                    with metrics.timer("controller_stage_seconds", stage="sensors", device=device):
+                        self.read_sensors()
+
+                    with metrics.timer("controller_stage_seconds", stage="autotune", device=device):
+                        if self.start_autotune:
+                            self.start_autotune_fc()
+                        if self.autotune_started:
+                            self.read_autotune_progress()
+
+                    with metrics.timer("controller_stage_seconds", stage="pid", device=device):
+                        if self.read_pid_values:
+                            self.read_pid_fc()
+
+                    with metrics.timer("controller_stage_seconds", stage="cycle", device=device):
+                        if self.start_cycle:
+                            self.cycle_basculement()
+
+                        if self.cycle_mode:
+                            self.cycle_basculement()
+                except ProtocolError as e:
+                    # The device stalled: report it and try again on the next tick
+                    self.status_callback = f"Controller error: {e}"
+                    print(self.status_callback)
+                    metrics.increment("controller_errors_total", device=device)
+                    return
+
+            with metrics.timer("controller_stage_seconds", stage="log", device=device):
+                timestamp = time.time()
+                self.valkey_log.log(self.r68_output, self.r65_output, timestamp=timestamp, device=self.device_id,
+                                    state=state_flags(self.cycle_mode, self.switchover_callback,
+                                                      self.autotune_started))
+                self.publish(EVENT_SAMPLE, (timestamp, self.r68_output, self.r65_output))
 
     def read_sensors(self):
         """
         Reads and stores data from registers 68 (Sensor D) and 65 (Sensor A).
         """
-        self.ser.write("$REG 68\r\n".encode())
-        ack = self.read_response().strip()
-        self.r68_output = self.extract_float(ack)
+        values = self.read_registers([68, 65])
+        self.r68_output = values.get(68)
+        self.r65_output = values.get(65)
+
+    def read_registers(self, registers):
+        """
+        Reads several registers in one burst: every `$REG n` query is written back to back,
+        then the replies are read and matched by register number.
+
+        :param registers: List of register numbers to read.
+        :returns: A dict mapping each register number to its value, None when the reply for
+            that register is missing or unparsable.
+        """
+        return self.transact("".join(f"$REG {register}\r\n" for register in registers), registers)
 
-        self.ser.write("$REG 65\r\n".encode())
-        ack = self.read_response().strip()
-        self.r65_output = self.extract_float(ack)
+    def write_registers(self, values):
+        """
+        Writes several registers in one burst: every `$REG n=v` command is written back to
+        back, then the acknowledgements are read and matched by register number.
 
-    def read_response(self):
+        :param values: Dict mapping register numbers to the values to write.
+        :returns: A dict mapping each register number to the value acknowledged by the
+            controller, None when the acknowledgement is missing or unparsable.
         """
-        Reads the response from the temperature controller.
+        return self.transact("".join(f"$REG {register}={value}\r\n" for register, value in values.items()),
+                             list(values))
 
-        :returns: The response from the controller as a string.
+    def write_register(self, register, value):
         """
-        response = b""
-        while True:
-            chunk = self.ser.read_until(b'\r\n')
-            response += chunk
-            if b'\r\n' in chunk:
-                break
-        return response.decode('ascii').strip()
+        Writes one register.
 
-    def extract_float(self, ack):
+        :returns: The value acknowledged by the controller, None when the acknowledgement is unparsable.
         """
-        Extracts a floating-point number from the controller's response.
+        return self.write_registers({register: value})[register]
 
-        :param ack: The response string from which to extract the float.
-        :returns: The extracted floating-point number.
+    def transact(self, commands, registers):
+        """
+        Sends a burst of commands and reads one reply per register, each within
+        `response_timeout`. On a timeout, the input is flushed and the whole burst is resent,
+        up to `retries` times.
+
+        :param commands: The commands to send, already framed.
+        :param registers: The registers the replies are expected for.
+        :raises ResponseTimeout: When the controller still didn't answer after the retries.
+        :returns: A dict mapping each register number to the value replied, None when missing.
+        """
+        data = commands.encode()
+        device = self.device_id or self.port
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timer("serial_transaction_seconds", device=device):
+                    self.ser.write(data)
+                    values = dict.fromkeys(registers)
+                    for _ in registers:
+                        reply = self.reader.read_reply(self.response_timeout)
+                        if reply.status == STATUS_OK and reply.register in values:
+                            values[reply.register] = reply.value
+                return values
+            except ResponseTimeout:
+                self.serial_retries += 1
+                metrics.increment("serial_retries_total", device=device)
+                self.resync()
+        raise ResponseTimeout(f"No reply from the controller on {self.port} after {self.retries + 1} attempts")
+
+    def resync(self):
+        """
+        Drops any partial or late reply so the next command starts on a clean frame boundary.
         """
-        pattern = r'=(\-?\d+(\.\d+)?)'
-        match = re.search(pattern, ack)
-        if match:
-            return float(match.group(1))
+        self.ser.reset_input_buffer()
+        self.reader.clear()
 
     def shut_down(self):
         with self.lock:
-            self.ser.write("$REG 2=0\r\n".encode())
-            ack = self.read_response()
-            if "REG 2=0" in ack:
+            try:
+                ack = self.write_register(2, 0)
+            except ProtocolError as e:
+                print(f"Error shutting down the controller: {e}")
+                return False
+            if ack == 0:
                 self.engine_running = False  # Stop the engine loop
                 return True
 
+    def close(self):
+        """
+        Flush the samples still waiting to be logged. Call once the engine is stopped.
+        A shared log is left to its ControllerManager.
+
+        :returns: True when every queued sample has been written in time.
+        """
+        if not self.owns_valkey_log:
+            return True
+        return self.valkey_log.close()
+
     def read_autotune_progress(self):
         """
         Reads the autotune value from the controller and updates the status accordingly.
         """
-        self.ser.write("$REG 1\r\n".encode())
-        ack = self.read_response().strip()
-        if ack.startswith("REG 1="):
-            reg_value = int(ack.split("=")[1])
-            if (reg_value & (1 << 11)) != 0:
-                self.status_callback = "Autotune complete"
-                self.autotune_started = False
-                self.ser.write("$REG 2=0\r\n".encode())
-                ack = self.read_response()
-                self.shut_down()
-            elif (reg_value & (1 << 12)) != 0:
-                self.status_callback = "Autotune failed"
-                self.autotune_started = False
-                self.ser.write("$REG 2=0\r\n".encode())
-                ack = self.read_response()
-                self.shut_down()
-            else:
-                self.status_callback = "Autotune in progress"
+        reg_value = self.read_registers([1])[1]
+        if reg_value is not None and self.autotune_step(int(reg_value)):
+            self.write_register(2, 0)
+            self.shut_down()
+
+    def autotune_step(self, reg_value):
+        """
+        Updates the autotune status from the value of register 1, without any I/O.
+
+        :param reg_value: Value of register 1, bit 11 is set on completion and bit 12 on failure.
+        :returns: True when the autotune is over and the controller must be stopped.
+        """
+        if (reg_value & (1 << 11)) != 0:
+            self.status_callback = "Autotune complete"
+            self.autotune_started = False
+            return True
+        elif (reg_value & (1 << 12)) != 0:
+            self.status_callback = "Autotune failed"
+            self.autotune_started = False
+            return True
+        else:
+            self.status_callback = "Autotune in progress"
+            return False
 
     def start_autotune_io(self):
         if not self.engine_running:
@@ -180,9 +329,7 @@ class TemperatureController:
         """
         Initiates the autotune process by sending the appropriate command to the controller.
         """
-        self.ser.write("$REG 2=4\r\n".encode())
-        ack = self.read_response()
-        if "REG 2=4" in ack:
+        if self.write_register(2, 4) == 4:
             self.start_autotune = False
             self.autotune_started = True
 
@@ -190,32 +337,30 @@ class TemperatureController:
         """
         Reads and stores the PID gain values from the controller's registers.
         """
-        for i in range(5, 8):  # Loop over register numbers 5, 6, 7
-            self.ser.write(f"$REG {i}\r\n".encode())
-            ack = self.read_response().strip()
-            gain_value = self.extract_float(ack)
-            if i == 5:
-                self.r5_gain_value = gain_value
-            elif i == 6:
-                self.r6_gain_value = gain_value
-            elif i == 7:
-                self.r7_gain_value = gain_value
+        self.publish_pid(self.read_registers([5, 6, 7]))
         if self.engine_running:
             self.read_pid_values = False
 
     def write_pid_values(self):
         with self.lock:
-            self.ser.write(f"$REG 5={self.new_p_value}\r\n".encode())
-            ack = self.read_response()
-            self.ser.write(f"$REG 6={self.new_i_value}\r\n".encode())
-            ack = self.read_response()
-            self.ser.write(f"$REG 7={self.new_d_value}\r\n".encode())
-            ack = self.read_response()
+            self.write_registers({5: self.new_p_value, 6: self.new_i_value, 7: self.new_d_value})
         if self.engine_running:
             self.read_pid_values = True
         else:
             self.read_pid_fc()
 
+    def start_profile_io(self, recipe, repeat=1):
+        """
+        Runs a recipe of ramp and soak segments (see Devices.profile) instead of the high/low cycle,
+        for this cycle only.
+
+        :param recipe: List of Segment.
+        :param repeat: Number of times the recipe is run.
+        """
+        self.recipe = recipe
+        self.wanted_nb_cycle = repeat
+        self.cycle_io()
+
     def cycle_io(self):
         if self.engine_running:
             self.start_cycle = True
@@ -225,79 +370,63 @@ class TemperatureController:
 
     def cycle_basculement(self):
         """
-        Handles the logic for temperature cycle switching based on the current cycle mode and settings.
-        """
-        if self.cycle_mode and self.current_nb_cycle < self.wanted_nb_cycle:
-
-            if self.switchover_callback == 1:
-                if self.use_percentage:
-                    pct_of_temp = self.high_temp * (self.percentage_threshold / 100)
-                    if self.r68_output >= pct_of_temp:
-                        self.switchover_callback = 2
-                        self.switchover_number += 1
-
-                else:
-                    if self.r68_output >= self.high_temp:
-                        self.switchover_callback = 2
-                        self.switchover_number += 1
-
-            elif self.switchover_callback == 2:
-                self.switchover_number += 1
-                r = self.switchover_number / 2
-                if r % self.time_btw_switchover == 0:
-                    self.switchover_callback = 3
-
-            elif self.switchover_callback == 3:
-                self.ser.write(f"$REG 4={self.low_temp}\r\n".encode())
-                ack = self.read_response()
-                self.switchover_callback = 4
-
-            elif self.switchover_callback == 4:
-                if self.use_percentage:
-                    pct_of_temp = self.low_temp * (1 + abs(self.percentage_threshold - 100) / 100)
-                    if self.r68_output <= pct_of_temp:
-                        self.switchover_callback = 5
-                        self.switchover_number += 1
-                else:
-                    if self.r68_output <= self.low_temp:
-                        self.switchover_callback = 5
-                        self.switchover_number += 1
-
-            elif self.switchover_callback == 5:
-                self.switchover_number += 1
-                r = self.switchover_number / 2
-                if r % self.time_btw_switchover == 0:
-                    self.switchover_callback = 6
-
-            elif self.switchover_callback == 6:
-                self.ser.write(f"$REG 4={self.high_temp}\r\n".encode())
-                ack = self.read_response()
-                self.switchover_callback = 1
-                self.current_nb_cycle += 1
-                self.status_callback = f"Cycle number : {self.current_nb_cycle} "
-
-        elif not self.cycle_mode:  # If not in cycle mode
-            self.ser.write(f"$REG 2=3\r\n".encode())
-            ack = self.read_response()
-            self.ser.write(f"$REG 4={self.high_temp}\r\n".encode())
-            ack = self.read_response()
-            self.cycle_mode = True
+        Runs one step of the cycle state machine and sends the setpoint changes it asks for.
+        Writes that fail are kept and resent on the next tick.
+        """
+        with metrics.timer("controller_stage_seconds", stage="cycle_logic", device=self.device_id or self.port):
+            writes, finished = self.cycle_step()
+        self.pending_writes.update(writes)
+        if self.pending_writes:
+            self.write_registers(self.pending_writes)
+            self.pending_writes = {}
+        if finished:
+            self.shut_down()
+
+    def cycle_step(self):
+        """
+        Runs the cycle profile: on the first call, compiles the recipe (or the high/low cycle) into
+        its step table, then moves through the steps whose targets are reached and dwells are over.
+        The setpoint is only written when the step changes. The state machine does no I/O, so
+        the serial and asyncio transports share it.
+
+        :returns: A tuple (writes, finished): the registers to write this tick, and whether all
+            the cycles are done and the controller must be shut down.
+        """
+        writes = {}
+        if not self.cycle_mode:
+            recipe = self.recipe or two_setpoint_recipe(self.high_temp, self.low_temp, self.time_btw_switchover,
+                                                        self.use_percentage, self.percentage_threshold)
+            self.recipe = None  # The next cycle is the high/low one unless start_profile_io is called again
             self.start_cycle = False
-            self.switchover_callback = 1
+            try:
+                steps = compile_profile(recipe, self.wanted_nb_cycle, start_temperature=self.r68_output)
+            except ValueError as e:
+                self.status_callback = f"Invalid cycle profile: {e}"
+                return writes, False
+            self.profile = ProfileRun(steps)
+            writes[2] = 3
+            self.cycle_mode = True
+            self.current_nb_cycle = 0
             self.status_callback = f"Cycle number : {self.current_nb_cycle} "
 
-        elif self.current_nb_cycle >= self.wanted_nb_cycle:  # If cycle limit reached
+        step_writes, entered = self.profile.advance(self.scheduler.tick_time, self.r68_output)
+        writes.update(step_writes)
+        self.switchover_callback = self.profile.phase()
+
+        if self.profile.finished:
+            self.cycle_mode = False
             self.current_nb_cycle = 0
-            self.switchover_callback = 0
-            self.switchover_number = 0
+            self.profile = None
             self.status_callback = "Cycle mode completed."
-            self.shut_down()
+            return writes, True
+
+        if entered and self.profile.step.cycle != self.current_nb_cycle:
+            self.current_nb_cycle = self.profile.step.cycle
+            self.status_callback = f"Cycle number : {self.current_nb_cycle} "
+        return writes, False
 
     def start_fan(self):
         """
         Sends a command to start the fan connected to the temperature controller.
         """
-        self.ser.write("$REG 39=1\r\n".encode())
-        ack = self.read_response()
-        self.ser.write("$REG 63=2\r\n".encode())
-        ack = self.read_response()
+        self.write_registers({39: 1, 63: 2})
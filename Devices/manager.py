@@ -0,0 +1,108 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+from Devices.controller import TemperatureController
+from utils.Metrics import metrics
+from utils.Scheduler import TickScheduler
+from utils.ValkeyFuncs import ValkeyLog, WriteBehindLog
+
+
+class ControllerManager:
+    def __init__(self, poll_rate=1.0, max_workers=4, valkey_log=None, events=None):
+        """
+        Drives several TemperatureControllers, one per serial port, from a single scheduler.
+
+        On each deadline, every running controller gets one `tick` on a small shared thread
+        pool, so the number of threads doesn't grow with the number of devices. A controller
+        whose previous tick is still running (stalled device) is skipped for that deadline
+        instead of delaying the others. All controllers log through one shared write-behind
+        queue, each sample tagged with its device ID.
+
+        :param poll_rate: Number of ticks per second, for every controller.
+        :param max_workers: Size of the thread pool running the ticks.
+        :param valkey_log: ValkeyLog the samples are written to, a default one when None.
+        :param events: Optional EventBus every controller publishes its live updates to.
+        """
+        self.scheduler = TickScheduler(poll_rate, name="manager")
+        self.valkey_log = WriteBehindLog(ValkeyLog() if valkey_log is None else valkey_log)
+        self.events = events
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="controller")
+        self.controllers = {}  # device ID -> TemperatureController
+        self.in_flight = {}  # device ID -> Future of the tick being run
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def device_id(port):
+        """
+        ID of the device connected to `port`, e.g. "ttyUSB0" or "COM3".
+        """
+        return os.path.basename(port)
+
+    def attach(self, port, **controller_options):
+        """
+        Connects a TemperatureController to `port` and adds it to the managed devices.
+
+        :raises serial.SerialException: When the port can't be opened.
+        :returns: The connected TemperatureController.
+        """
+        device_id = self.device_id(port)
+        controller = TemperatureController(port, device_id=device_id, scheduler=self.scheduler,
+                                           valkey_log=self.valkey_log, events=self.events, **controller_options)
+        controller.connection()
+        self.controllers[device_id] = controller
+        return controller
+
+    def attach_all(self, ports, **controller_options):
+        """
+        Attaches a controller to every port that can be opened.
+
+        :returns: The IDs of the attached devices.
+        """
+        for port in ports:
+            try:
+                self.attach(port, **controller_options)
+            except serial.SerialException as e:
+                print(f"Error connecting to {port}: {e}")
+        return self.device_ids()
+
+    def device_ids(self):
+        return list(self.controllers)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        self.scheduler.reset()
+        while self.running:
+            self.scheduler.wait()
+            for device_id, controller in list(self.controllers.items()):
+                if not controller.engine_running:
+                    continue
+                previous = self.in_flight.get(device_id)
+                if previous is not None:
+                    if not previous.done():
+                        metrics.increment("controller_ticks_skipped_total", device=device_id)
+                        continue  # Still busy with the last tick, don't queue up behind a stalled device
+                    if previous.exception():
+                        print(f"Error polling {device_id}: {previous.exception()}")
+                self.in_flight[device_id] = self.executor.submit(controller.tick)
+
+    def close(self, timeout=10):
+        """
+        Stops the polling loop, waits for the running ticks and drains the shared log.
+
+        :returns: True when every queued sample has been written in time.
+        """
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout)
+        self.executor.shutdown(wait=True)
+        return self.valkey_log.close(timeout)
@@ -0,0 +1,144 @@
+import math
+from collections import namedtuple
+
+SETPOINT_REGISTER = 4
+
+# Phases of a step, stored in the state flags of the samples (see utils.Records)
+PHASE_HEATING = 1  # Heading up to the target
+PHASE_COOLING = 4  # Heading down to the target
+PHASE_DWELL = 1  # Added to the phase while the target is held
+
+# One segment of a recipe. A ramp sets the setpoint to `target` and waits for the sensor to
+# come within `tolerance` of it, then holds it for `dwell` seconds. A soak holds `target` for
+# `dwell` seconds from the start of the segment, whatever the sensor reads.
+Segment = namedtuple('Segment', ['kind', 'target', 'tolerance', 'dwell'])
+
+# One compiled step. The step is reached once `low <= temperature <= high`, its dwell then
+# lasts `dwell` seconds. `write` is the setpoint to send on entry, None when it's unchanged.
+Step = namedtuple('Step', ['setpoint', 'write', 'low', 'high', 'dwell', 'phase', 'cycle'])
+
+
+def ramp(target, tolerance=0.0, dwell=0.0):
+    return Segment("ramp", float(target), float(tolerance), float(dwell))
+
+
+def soak(target, dwell):
+    return Segment("soak", float(target), 0.0, float(dwell))
+
+
+def two_setpoint_recipe(high_temp, low_temp, dwell, use_percentage=False, percentage_threshold=100):
+    """
+    Recipe of the classic cycle: heat to `high_temp`, hold, cool to `low_temp`, hold.
+
+    :param use_percentage: Consider a target reached within `percentage_threshold` percent of
+        it instead of exactly, e.g. 95 for 95 % of `high_temp` and 105 % of `low_temp`. Tolerances
+        are clamped at 0 (above 100, or below 0 °C), a ramp can't ask to overshoot its target.
+    """
+    high_tolerance = low_tolerance = 0.0
+    if use_percentage:
+        high_tolerance = max(0.0, high_temp * (1 - percentage_threshold / 100))
+        low_tolerance = max(0.0, low_temp * abs(percentage_threshold - 100) / 100)
+    return [ramp(high_temp, high_tolerance, dwell), ramp(low_temp, low_tolerance, dwell)]
+
+
+def compile_profile(recipe, repeat=1, start_temperature=None):
+    """
+    Unrolls a recipe into its table of steps, so running it costs the same on every tick
+    whatever its length: the thresholds, the setpoint writes and the direction of each ramp
+    are all computed here.
+
+    :param recipe: List of Segment, see `ramp` and `soak`.
+    :param repeat: Number of times the recipe is run.
+    :param start_temperature: Temperature when the profile starts, tells whether the first ramp
+        heats or cools. Heating is assumed when None.
+    :raises ValueError: When the recipe is empty or a segment is invalid.
+    :returns: A tuple of Step.
+    """
+    if not recipe:
+        raise ValueError("Empty recipe")
+    for segment in recipe:
+        if segment.kind not in ("ramp", "soak"):
+            raise ValueError(f"Unknown segment kind: {segment.kind}")
+        if segment.tolerance < 0 or segment.dwell < 0:
+            raise ValueError(f"Negative tolerance or dwell in {segment}")
+
+    steps = []
+    previous = start_temperature
+    setpoint = None  # Last setpoint written
+    phase = PHASE_HEATING
+    for cycle in range(repeat):
+        for segment in recipe:
+            if segment.kind == "ramp":
+                heating = previous is None or segment.target >= previous
+                phase = PHASE_HEATING if heating else PHASE_COOLING
+                if heating:
+                    low, high = segment.target - segment.tolerance, math.inf
+                else:
+                    low, high = -math.inf, segment.target + segment.tolerance
+            else:
+                low, high = -math.inf, math.inf
+            write = None if segment.target == setpoint else segment.target
+            steps.append(Step(segment.target, write, low, high, segment.dwell, phase, cycle))
+            previous = setpoint = segment.target
+    return tuple(steps)
+
+
+class ProfileRun:
+    def __init__(self, steps):
+        """
+        Runs a compiled profile, one `advance` per engine tick. Dwell deadlines are taken on
+        the monotonic tick time, so they don't depend on the poll rate or on skipped ticks.
+
+        :param steps: Step table returned by `compile_profile`.
+        """
+        self.steps = steps
+        self.index = -1  # Step being run, -1 before the first one
+        self.deadline = None  # Monotonic time at which the dwell of the step ends, None until reached
+
+    @property
+    def step(self):
+        return self.steps[self.index] if 0 <= self.index < len(self.steps) else None
+
+    @property
+    def finished(self):
+        return self.index >= len(self.steps)
+
+    def phase(self):
+        """
+        Phase of the current step, plus PHASE_DWELL while its target is held. 0 when not running.
+        """
+        step = self.step
+        if step is None:
+            return 0
+        return step.phase + (PHASE_DWELL if self.deadline is not None else 0)
+
+    def advance(self, now, temperature):
+        """
+        Moves through the steps whose targets are reached and dwells are over.
+
+        :param now: Monotonic time of the tick.
+        :param temperature: Sensor reading, None when it couldn't be read.
+        :returns: A tuple (writes, entered): the setpoint to write when the step changed, and
+            the number of steps entered on this tick.
+        """
+        writes = {}
+        entered = 0
+        while not self.finished:
+            step = self.step
+            if step is not None:
+                if self.deadline is None:
+                    gated = step.low > -math.inf or step.high < math.inf  # Soaks don't wait for the sensor
+                    if gated and (temperature is None or not step.low <= temperature <= step.high):
+                        break
+                    self.deadline = now + step.dwell
+                if now < self.deadline:
+                    break
+
+            # Enter the next step
+            self.index += 1
+            self.deadline = None
+            entered += 1
+            step = self.step
+            if step is not None and step.write is not None:
+                writes[SETPOINT_REGISTER] = step.write
+        return writes, entered
@@ -0,0 +1,106 @@
+import re
+import time
+from collections import namedtuple
+
+# One reply frame is `REG <n>=<value>\r\n`, the same frame acknowledges reads and writes
+REPLY_PATTERN = re.compile(rb'REG\s*(\d+)\s*=\s*(-?\d+(?:\.\d+)?)')
+FRAME_END = b'\r\n'
+
+STATUS_OK = "ok"
+STATUS_INVALID = "invalid"  # A complete frame was received but isn't a register reply
+
+Reply = namedtuple('Reply', ['register', 'value', 'status'])
+
+
+class ProtocolError(Exception):
+    """
+    The controller didn't answer as expected.
+    """
+
+
+class ResponseTimeout(ProtocolError):
+    """
+    No complete reply frame was received before the deadline.
+    """
+
+
+class ConnectionLost(ProtocolError):
+    """
+    The port failed (unplugged adapter, closed pty), no reply will ever come.
+    """
+
+
+def parse_reply(data, start=0, end=None):
+    """
+    Parses a reply frame in place, without copying it out of its buffer.
+
+    :param data: bytes-like object holding the frame.
+    :param start: Index where the frame starts in `data`.
+    :param end: Index where the frame ends in `data` (terminator excluded).
+    :returns: A Reply(register, value, status) tuple, register and value being None when the
+        frame isn't a register reply.
+    """
+    match = REPLY_PATTERN.search(data, start, len(data) if end is None else end)
+    if match:
+        return Reply(int(match.group(1)), float(match.group(2)), STATUS_OK)
+    return Reply(None, None, STATUS_INVALID)
+
+
+class FrameReader:
+    def __init__(self, ser, buffer_size=256):
+        """
+        Reads `\\r\\n` terminated frames from a serial port into a preallocated buffer.
+
+        The port must be opened with a short read timeout, the overall deadline of a read is
+        enforced here with the monotonic clock.
+
+        :param ser: An open serial.Serial (or any object with `read` and `in_waiting`).
+        :param buffer_size: Size of the receive buffer, longer lines are discarded.
+        """
+        self.ser = ser
+        self.buffer = bytearray(buffer_size)
+        self.start = 0  # First unread byte
+        self.end = 0  # One past the last received byte
+
+    def clear(self):
+        """
+        Drops everything received so far, used to resync after a timeout or garbage.
+        """
+        self.start = 0
+        self.end = 0
+
+    def read_reply(self, timeout):
+        """
+        Reads and parses the next reply frame.
+
+        :param timeout: Maximum time to wait for a complete frame, in seconds.
+        :raises ResponseTimeout: When no complete frame arrived before the deadline.
+        :returns: A Reply(register, value, status) tuple.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            index = self.buffer.find(FRAME_END, self.start, self.end)
+            if index >= 0:
+                reply = parse_reply(self.buffer, self.start, index)
+                self.start = index + len(FRAME_END)
+                if self.start == self.end:
+                    self.clear()
+                return reply
+
+            if self.end == len(self.buffer):
+                if self.start == 0:
+                    # A line longer than the buffer can only be garbage, drop it and resync
+                    self.clear()
+                else:
+                    # Move the partial frame to the front to make room
+                    size = self.end - self.start
+                    self.buffer[:size] = self.buffer[self.start:self.end]
+                    self.start, self.end = 0, size
+
+            if time.monotonic() >= deadline:
+                raise ResponseTimeout(f"No reply from the controller within {timeout} s")
+
+            free = len(self.buffer) - self.end
+            chunk = self.ser.read(min(free, max(1, self.ser.in_waiting)))
+            self.buffer[self.end:self.end + len(chunk)] = chunk
+            self.end += len(chunk)
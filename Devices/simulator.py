@@ -0,0 +1,176 @@
+import math
+import os
+import pty
+import random
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from Devices.protocol import FRAME_END
+
+# A command is `$REG <n>\r\n` (read) or `$REG <n>=<value>\r\n` (write)
+COMMAND_PATTERN = re.compile(rb'\$REG\s*(\d+)\s*(?:=\s*(-?\d+(?:\.\d+)?))?')
+
+AUTOTUNE_COMPLETE = 1 << 11
+AUTOTUNE_FAILED = 1 << 12
+
+
+class SimulatedController:
+    def __init__(self, ambient=20.0, time_constant=60.0, max_rate=2.0, sensor_lag=15.0, noise=0.0,
+                 latency=0.0, jitter=0.0, autotune_duration=30.0, autotune_fails=False, clock=time.monotonic):
+        """
+        Fake temperature controller answering the `$REG` protocol on a pseudo-terminal, so the
+        controller, logging, graph and export paths can be run without hardware.
+
+        Open `port` like a real serial port. The heater drives sensor D (REG 68) towards the
+        setpoint (REG 4) while the mode (REG 2) is cycle (3) or autotune (4), and back towards
+        ambient otherwise, as a first order system with a limited heating rate. Sensor A (REG 65)
+        follows sensor D with a lag. An autotune sets bit 11 (or bit 12 when it fails) of REG 1
+        once `autotune_duration` has elapsed, and loads new PID gains in REG 5, 6 and 7.
+
+        :param ambient: Ambient temperature, also the initial temperature of both sensors.
+        :param time_constant: Time constant of sensor D, in seconds.
+        :param max_rate: Maximum heating or cooling rate of sensor D, in degrees per second.
+        :param sensor_lag: Time constant of sensor A following sensor D, in seconds.
+        :param noise: Standard deviation of the noise added to the sensor readings.
+        :param latency: Delay before each reply is sent, in seconds.
+        :param jitter: Random extra delay added to each reply, up to this many seconds.
+        :param autotune_duration: Time an autotune takes, in seconds.
+        :param autotune_fails: Report an autotune failure (bit 12) instead of a success (bit 11).
+        :param clock: Monotonic clock driving the thermal model, replaceable to speed up time.
+        """
+        self.ambient = ambient
+        self.time_constant = time_constant
+        self.max_rate = max_rate
+        self.sensor_lag = sensor_lag
+        self.noise = noise
+        self.latency = latency
+        self.jitter = jitter
+        self.autotune_duration = autotune_duration
+        self.autotune_fails = autotune_fails
+        self.clock = clock
+
+        self.registers = {1: 0, 2: 0, 4: ambient, 5: 10, 6: 5, 7: 1, 39: 0, 63: 0, 65: ambient, 68: ambient}
+        self.autotune_start = None
+        self.last_update = None
+        self.commands = 0  # Commands answered since the start
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Starts answering on `port` from a background thread.
+
+        :returns: The path of the port to connect to.
+        """
+        if not self.running:
+            self.running = True
+            self.last_update = self.clock()
+            self.thread = threading.Thread(target=self.serve, daemon=True)
+            self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def serve(self):
+        """
+        Reads commands from the pty and writes each reply once its latency has elapsed.
+        """
+        received = bytearray()
+        outgoing = deque()  # (send time, reply), in send order since every reply has the same latency
+        while self.running:
+            timeout = 0.05 if not outgoing else max(0.0, min(0.05, outgoing[0][0] - time.monotonic()))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                received += os.read(self.master, 4096)
+                while True:
+                    index = received.find(FRAME_END)
+                    if index < 0:
+                        break
+                    reply = self.handle(bytes(received[:index]))
+                    del received[:index + len(FRAME_END)]
+                    if reply is not None:
+                        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+                        outgoing.append((time.monotonic() + delay, reply))
+
+            while outgoing and outgoing[0][0] <= time.monotonic():
+                os.write(self.master, outgoing.popleft()[1])
+
+    def handle(self, command):
+        """
+        Applies one command and returns its reply frame, None when it isn't a register command.
+        """
+        match = COMMAND_PATTERN.search(command)
+        if not match:
+            return None
+        self.update()
+        register = int(match.group(1))
+        if match.group(2) is not None:
+            self.write(register, float(match.group(2)))
+        self.commands += 1
+        return f"REG {register}={self.format_value(self.read(register))}\r\n".encode()
+
+    def read(self, register):
+        value = self.registers.get(register, 0)
+        if register in (65, 68) and self.noise:
+            value += random.gauss(0, self.noise)
+        return value
+
+    def write(self, register, value):
+        if register in (65, 68):
+            return  # Sensors are read-only
+        if value.is_integer():
+            value = int(value)  # Keeps the status bits of REG 1 usable
+        if register == 2 and value == 4 and self.registers.get(2) != 4:
+            self.autotune_start = self.clock()
+            self.registers[1] &= ~(AUTOTUNE_COMPLETE | AUTOTUNE_FAILED)
+        if register == 2 and value != 4:
+            self.autotune_start = None
+        self.registers[register] = value
+
+    def update(self):
+        """
+        Advances the thermal model and the autotune to the current time.
+        """
+        now = self.clock()
+        elapsed = now - self.last_update if self.last_update is not None else 0.0
+        self.last_update = now
+
+        heating = self.registers[2] in (3, 4)
+        target = self.registers[4] if heating else self.ambient
+        sensor_d = self.registers[68]
+        step = (target - sensor_d) * (1 - math.exp(-elapsed / self.time_constant))
+        limit = self.max_rate * elapsed
+        sensor_d += max(-limit, min(limit, step))
+        self.registers[68] = sensor_d
+        self.registers[65] += (sensor_d - self.registers[65]) * (1 - math.exp(-elapsed / self.sensor_lag))
+
+        if self.autotune_start is not None and now - self.autotune_start >= self.autotune_duration:
+            self.autotune_start = None
+            if self.autotune_fails:
+                self.registers[1] |= AUTOTUNE_FAILED
+            else:
+                self.registers[1] |= AUTOTUNE_COMPLETE
+                self.registers.update({5: 12, 6: 4, 7: 2})
+
+    @staticmethod
+    def format_value(value):
+        if float(value).is_integer():
+            return str(int(value))
+        return f"{value:.2f}"
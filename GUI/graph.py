@@ -1,138 +1,398 @@
 import customtkinter as tk
-import pandas as pd
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from datetime import datetime, timedelta
-import matplotlib.dates as mdates
-from threading import Lock
-import redis
+import time
+from collections import deque
+from datetime import datetime
 
+SAMPLE_RATE_HZ = 1  # Default rate at which the controller engine logs samples, see GraphPage
+DECIMATION_POINTS_PER_PIXEL = 2  # Above this density, series are reduced to min/max per pixel column
+X_MARGIN = 0.05  # Blit mode: fraction of the window kept free on the right before the axes must move
+Y_MARGIN = 0.05  # Blit mode: padding added around the data when the y limits must move
 
-class GraphPage(tk.CTkFrame):
 
-    def __init__(self, master, last_minutes=30):
-        super().__init__(master)
+def minmax_decimate(times, values, start, end, buckets):
+    """
+    Reduce a time series to the min and max of every bucket (pixel column) between `start` and
+    `end`, so the envelope drawn on screen is exactly the one of the raw data.
+
+    :param times: Sorted epoch seconds of the samples.
+    :param values: Sample values, NaN for missing readings.
+    :param start: Left edge of the first bucket.
+    :param end: Right edge of the last bucket.
+    :param buckets: Number of buckets, usually the width of the axes in pixels.
+    :returns: A (times, values) tuple holding two points per non-empty bucket.
+    """
+    import numpy as np
+
+    edges = np.linspace(start, end, buckets + 1)
+    bounds = np.unique(np.searchsorted(times, edges[:-1]))
+    bounds = bounds[bounds < len(times)]
+    if len(bounds) == 0:
+        return times[:0], values[:0]
+
+    decimated = np.empty(2 * len(bounds), dtype=values.dtype)
+    decimated[0::2] = np.fmin.reduceat(values, bounds)
+    decimated[1::2] = np.fmax.reduceat(values, bounds)
+    return np.repeat(times[bounds], 2), decimated
+
+
+class DeviceSeries:
+    def __init__(self, ax, valkey_log, capacity, blit):
+        """
+        Samples and lines of one device on the graph.
+
+        :param ax: Axes the two sensor lines are drawn on.
+        :param valkey_log: ValkeyLog bound to the device.
+        :param capacity: Capacity of the ring buffer.
+        :param blit: Whether the lines are animated artists.
+        """
+        # numpy is only imported with the graph, see GraphPage.build
+        from utils.RingBuffer import SampleRingBuffer
+
+        self.valkey_log = valkey_log
+        self.cursor = None  # Position of the last sample read from Valkey
+        self.tier = None  # Rollup tier the buffer is filled from, in seconds, None for the raw samples
+        self.buffer = SampleRingBuffer(capacity)
+        self.early = deque(maxlen=capacity)  # Samples pushed before the backfill, merged after it
+
+        device = valkey_log.device
+        suffix = "" if device is None else f" ({device})"
+        self.plot_d = ax.plot(self.buffer.times, self.buffer.sensor_d, label=f'Sensor D{suffix}',
+                              animated=blit)[0]
+        # A single untagged device keeps the historical orange for Sensor A
+        self.plot_a = ax.plot(self.buffer.times, self.buffer.sensor_a, label=f'Sensor A{suffix}',
+                              color='orange' if device is None else None, animated=blit)[0]
+
+    def reset(self, capacity, tier=None):
+        """
+        Empties the buffer so it's reloaded from scratch, from the raw samples or from a rollup tier.
+        """
+        from utils.RingBuffer import SampleRingBuffer
+
+        self.buffer = SampleRingBuffer(capacity)
+        self.early = deque(self.early, maxlen=capacity)
+        self.cursor = None
+        self.tier = tier
+
+    def merge_early(self):
+        """
+        Appends the samples pushed while the buffer was being backfilled, skipping those the
+        backfill already read from the log (the write-behind log may not have written the
+        others yet).
+        """
+        for timestamp, sensor_d, sensor_a in self.early:
+            if len(self.buffer) == 0 or timestamp > self.buffer.times[-1]:
+                self.buffer.append(timestamp, sensor_d, sensor_a)
+        self.early.clear()
+
+    def remove(self):
+        self.plot_d.remove()
+        self.plot_a.remove()
+
+
+class LivePlot:
+    def __init__(self, figure, canvas, valkey_log, devices=None, last_minutes=30, blit=True, push=False,
+                 sample_rate=SAMPLE_RATE_HZ):
+        """
+        The live graph and the work of one frame, independent of the toolkit: GraphPage draws
+        it on a Tk canvas, the benchmark on an off-screen one.
+
+        :param figure: matplotlib Figure the axes are added to.
+        :param canvas: Canvas of `figure`.
+        :param valkey_log: ValkeyLog the samples are read from.
+        See GraphPage for the other parameters.
+        """
+        from matplotlib.ticker import FuncFormatter
+
+        self.figure = figure
+        self.canvas = canvas
+        self.valkey_log = valkey_log
         self.last_minutes = last_minutes
-        self.figure = Figure(figsize=(5, 5), dpi=100)
+        self.blit = blit
+        self.push = push
+        self.sample_rate = sample_rate
+        self.background = None  # Cached static part of the figure in blit mode
+        self.view_stale = True  # The axes limits must be recomputed on the next tick
+        self.series = []
+
         self.ax = self.figure.add_subplot(111)
-        myFmt = mdates.DateFormatter("%H:%M:%S")
+        # The x axis is in epoch seconds, straight from the ring buffers
+        myFmt = FuncFormatter(lambda x, pos: datetime.fromtimestamp(x).strftime("%H:%M:%S"))
         self.ax.xaxis.set_major_formatter(myFmt)
 
-        # Initialize data and plot for Sensor D
-        self.x_data, self.y_data_d, self.y_data_a = self.get_initial_data()
-        self.plot_d = self.ax.plot(self.x_data, self.y_data_d, label='Sensor D')[0]
-
-        # Initialize plot for Sensor A
-        self.plot_a = self.ax.plot(self.x_data, self.y_data_a, label='Sensor A', color='orange')[0]
+        # Initialize data and plots for Sensor D and Sensor A of every device
+        self.set_devices(devices, redraw=False)
 
         self.ax.set_ylim(0, 100)  # Adjust according to your sensor data range
-        self.ax.set_xlim(datetime.now() - timedelta(minutes=self.last_minutes), datetime.now())
+        now = time.time()
+        self.ax.set_xlim(now - self.last_minutes * 60, now)
 
         self.ax.grid(which='major', axis='both', linestyle='--', color='grey', alpha=0.5)
+
+        if self.blit:
+            self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def set_source(self, valkey_log, devices=None):
+        """
+        Plots the samples of `valkey_log`.
+
+        :param devices: List of device IDs, None for the untagged samples.
+        """
+        self.valkey_log = valkey_log
+        self.set_devices(devices)
+
+    def set_devices(self, devices, redraw=True):
+        """
+        Chooses the devices plotted.
+
+        :param devices: List of device IDs, None for the untagged samples.
+        """
+        for series in self.series:
+            series.remove()
+        self.series = [DeviceSeries(self.ax, self.valkey_log.for_device(device),
+                                    self.buffer_capacity(self.last_minutes), self.blit)
+                       for device in (devices or [None])]
         self.ax.legend()  # Add legend to the plot
+        self.fetch_data_from_redis()
+        self.view_stale = True
+        if redraw:
+            self.update_graph()
 
-        self.canvas = FigureCanvasTkAgg(self.figure, self)
-        self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+    def devices(self):
+        return [series.valkey_log.device for series in self.series]
 
-        self.animate()  # launch the animation
+    def buffer_capacity(self, last_minutes, tier=None):
+        """
+        Number of samples the ring buffer needs to hold `last_minutes` of data, with some slack
+        for jitter in the logging rate. A rollup bucket takes two points (its min and its max).
+        """
+        if tier is None:
+            return int(last_minutes * 60 * self.sample_rate * 1.1) + 1
+        return int(2 * last_minutes * 60 / tier * 1.1) + 2
 
-    @staticmethod
-    def fetch_data_from_redis(last_minutes=15):
-        with Lock():
+    def choose_tier(self):
+        """
+        Coarsest rollup tier that still gives at least one bucket per pixel column over
+        `last_minutes`, None when only the raw samples are fine enough.
+        """
+        width = max(1, int(self.ax.bbox.width))
+        span = self.last_minutes * 60
+        tiers = [tier for tier in self.valkey_log.rollup_tiers if span / tier >= width]
+        return max(tiers) if tiers else None
+
+    def fetch_data_from_redis(self):
+        """
+        Fetch only the samples logged since the previous tick and append them to the ring
+        buffers, then evict the samples older than `last_minutes`.
+
+        Long windows are read from a rollup tier instead of the raw samples, each bucket
+        drawn as its min and max so the envelope of the data is kept.
+        """
+        oldest = time.time() - self.last_minutes * 60
+        tier = self.choose_tier()
+        for series in self.series:
+            if series.tier != tier:
+                series.reset(self.buffer_capacity(self.last_minutes, tier), tier)
+            if self.push and tier is None and series.cursor is not None:
+                series.buffer.evict_before(oldest)
+                continue  # Backfilled, the new samples are pushed
             try:
-                r = redis.Redis(host='localhost', port=6379, db=0)
-                keys = r.keys('data_*')
-                data_list = []
-                for key in keys:
-                    if r.type(key) == b'hash':  # Ensure the key is of hash type
-                        data = r.hgetall(key)
-                        timestamp = datetime.strptime(data[b'timestamp'].decode('utf-8'), "%Y-%m-%d %H:%M:%S")
-                        if timestamp >= datetime.now() - timedelta(minutes=last_minutes):
-                            sensor_d = float(data[b'sensor_d'].decode('utf-8'))
-                            sensor_a = float(data[b'sensor_a'].decode('utf-8'))
-                            data_list.append((timestamp, sensor_d, sensor_a))
-                df = pd.DataFrame(data_list, columns=['timestamp', 'sensor_d', 'sensor_a'])
-                df.sort_values('timestamp', inplace=True)
-                return df
+                if tier is None:
+                    samples, series.cursor = series.valkey_log.fetch_since(series.cursor, start=oldest * 1000,
+                                                                           backfill=series.buffer.capacity)
+                else:
+                    buckets, series.cursor = series.valkey_log.fetch_rollups_since(tier, series.cursor,
+                                                                                   start=(oldest - tier) * 1000)
+                    samples = []
+                    for start_ms, d_min, d_max, _, _, a_min, a_max, _, _ in buckets:
+                        samples.append((start_ms, d_min, a_min))
+                        samples.append((start_ms + tier * 500, d_max, a_max))
             except Exception as e:
                 print(f"Error fetching data: {e}")
-                return pd.DataFrame(columns=['timestamp', 'sensor_d', 'sensor_a'])
+                samples = []
 
-    def get_initial_data(self):
-        df = self.fetch_data_from_redis(self.last_minutes)
-        if not df.empty:
-            return list(df['timestamp']), list(df['sensor_d']), list(df['sensor_a'])
-        else:
-            now = datetime.now()
-            x_data = [now - timedelta(minutes=self.last_minutes) + timedelta(seconds=i) for i in
-                      range(0, self.last_minutes * 60, 60)]
-            y_data_d = [0 for _ in range(len(x_data))]
-            y_data_a = [0 for _ in range(len(x_data))]
-            return x_data, y_data_d, y_data_a
+            for timestamp_ms, sensor_d, sensor_a in samples:
+                series.buffer.append(timestamp_ms / 1000, sensor_d, sensor_a)
+            if self.push and tier is None and series.cursor is not None:
+                series.merge_early()
 
-    def update_minutes(self, value):
-        self.last_minutes = int(value)
+            series.buffer.evict_before(oldest)
+
+    def update_minutes(self, last_minutes):
+        if last_minutes != self.last_minutes:
+            # Resize the buffers and reload them from scratch to backfill the older samples
+            for series in self.series:
+                series.reset(self.buffer_capacity(last_minutes, series.tier), series.tier)
+            self.view_stale = True
+        self.last_minutes = last_minutes
         self.update_graph()
 
-    # def update_graph(self):
-    #     df = self.fetch_data_from_redis(self.last_minutes)
-    #     if not df.empty:
-    #         self.x_data = list(df['timestamp'])
-    #         self.y_data_d = list(df['sensor_d'])
-    #         self.y_data_a = list(df['sensor_a'])
-    #     else:
-    #         now = datetime.now()
-    #         self.x_data = [now - timedelta(minutes=self.last_minutes) + timedelta(seconds=i) for i in
-    #                        range(0, self.last_minutes * 60, 60)]
-    #         self.y_data_d = [0 for _ in range(len(self.x_data))]
-    #         self.y_data_a = [0 for _ in range(len(self.x_data))]
-    #
-    #     self.plot_d.set_xdata(self.x_data)
-    #     self.plot_d.set_ydata(self.y_data_d)
-    #     self.plot_a.set_xdata(self.x_data)
-    #     self.plot_a.set_ydata(self.y_data_a)
-    #     self.ax.set_xlim(datetime.now() - timedelta(minutes=self.last_minutes), datetime.now())
-    #
-    #     if self.y_data_d and self.y_data_a:
-    #         self.ax.set_ylim(min(min(self.y_data_d), min(self.y_data_a)), max(max(self.y_data_d), max(self.y_data_a)))
-    #     else:
-    #         self.ax.set_ylim(0, 1)
-    #
-    #     self.canvas.draw_idle()
+    def y_limits(self):
+        """
+        Y limits covering the samples of every plotted device.
+        """
+        limits = [series.buffer.y_limits(default=None) for series in self.series]
+        limits = [limit for limit in limits if limit is not None]
+        if not limits:
+            return 0, 100
+        return min(low for low, _ in limits), max(high for _, high in limits)
+
+    def update_line_data(self):
+        """
+        Hand the ring buffers to the lines, decimated to min/max per pixel column when there
+        are more points than the axes can show.
+        """
+        width = max(1, int(self.ax.bbox.width))
+        x_min, x_max = self.ax.get_xlim()
+        for series in self.series:
+            buffer = series.buffer
+            times = buffer.times
+            if len(times) > width * DECIMATION_POINTS_PER_PIXEL:
+                series.plot_d.set_data(*minmax_decimate(times, buffer.sensor_d, x_min, x_max, width))
+                series.plot_a.set_data(*minmax_decimate(times, buffer.sensor_a, x_min, x_max, width))
+            else:
+                # Ordered views of the ring buffer, no copy
+                series.plot_d.set_data(times, buffer.sensor_d)
+                series.plot_a.set_data(times, buffer.sensor_a)
 
     def update_graph(self):
-        df = self.fetch_data_from_redis(self.last_minutes)
-        if not df.empty:
-            self.x_data = list(df['timestamp'])
-            self.y_data_d = list(df['sensor_d'])
-            self.y_data_a = list(df['sensor_a'])
+        self.fetch_data_from_redis()
+        now = time.time()
+        span = self.last_minutes * 60
+
+        if not self.blit:
+            self.ax.set_ylim(*self.y_limits())
+            self.ax.set_xlim(now - span, now)
+            self.update_line_data()
+            self.canvas.draw_idle()
+            return
+
+        # In blit mode the view only moves when the data is about to leave it
+        full_redraw = self.background is None
+        x_min, x_max = self.ax.get_xlim()
+        if self.view_stale or now > x_max:
+            self.ax.set_xlim(now - span, now + span * X_MARGIN)
+            full_redraw = True
+
+        y_low, y_high = self.y_limits()
+        y_min, y_max = self.ax.get_ylim()
+        if self.view_stale or y_low < y_min or y_high > y_max:
+            pad = (y_high - y_low) * Y_MARGIN
+            self.ax.set_ylim(y_low - pad, y_high + pad)
+            full_redraw = True
+        self.view_stale = False
+
+        self.update_line_data()
+        if full_redraw:
+            self.canvas.draw_idle()  # on_draw caches the new background and draws the lines
         else:
-            now = datetime.now()
-            self.x_data = [now - timedelta(minutes=self.last_minutes) + timedelta(seconds=i) for i in
-                           range(0, self.last_minutes * 60, 60)]
-            self.y_data_d = [0 for _ in range(len(self.x_data))]
-            self.y_data_a = [0 for _ in range(len(self.x_data))]
-
-        # Update the plot data
-        self.plot_d.set_xdata(self.x_data)
-        self.plot_d.set_ydata(self.y_data_d)
-        self.plot_a.set_xdata(self.x_data)
-        self.plot_a.set_ydata(self.y_data_a)
-
-        # Recalculate limits and apply autoscale
-        self.ax.relim()
-        self.ax.autoscale_view(True, True, True)
-
-        if self.y_data_d and self.y_data_a:
-            self.ax.set_ylim(min(min(self.y_data_d), min(self.y_data_a)), max(max(self.y_data_d), max(self.y_data_a)))
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.ax.bbox)
+
+    def on_draw(self, event):
+        """
+        After every full draw, cache the static background and draw the animated lines on it.
+        """
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        for series in self.series:
+            self.ax.draw_artist(series.plot_d)
+            self.ax.draw_artist(series.plot_a)
+
+    def push_samples(self, samples):
+        """
+        Appends samples pushed by the controllers and redraws the graph once.
+
+        :param samples: A list of (device, epoch_seconds, sensor_d, sensor_a) tuples.
+        """
+        series_by_device = {series.valkey_log.device: series for series in self.series}
+        for device, timestamp, sensor_d, sensor_a in samples:
+            series = series_by_device.get(device)
+            if series is None or series.tier is not None:
+                continue  # Not plotted, or plotted from a rollup tier: read on update
+            if series.cursor is None:
+                series.early.append((timestamp, sensor_d, sensor_a))  # Merged once backfilled
+                continue
+            buffer = series.buffer
+            if len(buffer) == 0 or timestamp > buffer.times[-1]:
+                buffer.append(timestamp, sensor_d, sensor_a)
+        self.update_graph()
+
+
+class GraphPage(tk.CTkFrame):
+
+    def __init__(self, master, last_minutes=30, blit=True, devices=None, valkey_log=None, push=False,
+                 sample_rate=SAMPLE_RATE_HZ):
+        """
+        :param last_minutes: Length of the time window displayed.
+        :param blit: Cache the static background (axes, grid, legend) and only redraw the
+            sensor lines on each tick. The full figure is redrawn only when the view has to move.
+        :param devices: IDs of the devices to plot, None plots the untagged samples.
+        :param valkey_log: ValkeyLog the samples are read from. When None, the figure is only
+            built once one is given to `set_source`.
+        :param push: New samples are handed over with `push_samples` as the controllers produce
+            them, and the graph is only redrawn then. Valkey is only read to backfill the window
+            and for rollup tiers. Otherwise Valkey is polled every second.
+        :param sample_rate: Samples logged per second by each device (the poll rate), sizes the
+            buffers and the backfill.
+        """
+        super().__init__(master)
+        self.last_minutes = last_minutes
+        self.blit = blit
+        self.push = push
+        self.sample_rate = sample_rate
+        self.valkey_log = valkey_log
+        self.plot = None  # LivePlot, built on first use, see build
+        if valkey_log is not None:
+            self.build(devices)
+
+    def build(self, devices=None):
+        """
+        Creates the figure and starts the animation. matplotlib and numpy are only imported from
+        here, so they don't delay the first frame of the window.
+        """
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize=(5, 5), dpi=100)
+        canvas = FigureCanvasTkAgg(figure, self)
+        self.plot = LivePlot(figure, canvas, self.valkey_log, devices, last_minutes=self.last_minutes,
+                             blit=self.blit, push=self.push, sample_rate=self.sample_rate)
+        canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+
+        self.animate()  # launch the animation
+
+    def set_source(self, valkey_log, devices=None):
+        """
+        Plots the samples of `valkey_log`, building the figure on the first call.
+
+        :param devices: List of device IDs, None for the untagged samples.
+        """
+        self.valkey_log = valkey_log
+        if self.plot is None:
+            self.build(devices)
         else:
-            self.ax.set_ylim(0, 100)  # Fallback Y-limits
+            self.plot.set_source(valkey_log, devices)
 
-        self.ax.set_xlim(datetime.now() - timedelta(minutes=self.last_minutes), datetime.now())
+    def set_devices(self, devices):
+        self.plot.set_devices(devices)
 
-        self.canvas.draw_idle()
+    def update_minutes(self, value):
+        self.last_minutes = int(value)
+        if self.plot is not None:
+            self.plot.update_minutes(self.last_minutes)
 
+    def push_samples(self, samples):
+        """
+        Hands the samples pushed by the controllers to the plot, see LivePlot.push_samples.
+        """
+        if self.plot is None:
+            return  # Not built yet, the samples are backfilled from the log then
+        self.plot.push_samples(samples)
 
     def animate(self):
-        self.update_graph()
-        self.after(1000, self.animate)  # repeat after 1s
\ No newline at end of file
+        self.plot.update_graph()
+        if not self.push:
+            self.after(1000, self.animate)  # repeat after 1s
@@ -3,8 +3,10 @@ from GUI.graph import GraphPage
 
 
 class MainWindow(tk.CTk):
-    def __init__(self, app_settings, start_autotune_callback, send_pid_callback, stop_command, start_cycle_callback):
+    def __init__(self, app_settings, start_autotune_callback, send_pid_callback, stop_command, start_cycle_callback,
+                 valkey_log=None, push_updates=False):
         super().__init__()
+        self.app_settings = app_settings
         self.title(app_settings.title)
         self.geometry(app_settings.default_geometry(self))
 
@@ -13,6 +15,8 @@ class MainWindow(tk.CTk):
         self.send_pid_callback = send_pid_callback
         self.stop_command = stop_command
         self.start_cycle_callback = start_cycle_callback  # Store the start cycle callback
+        self.valkey_log = valkey_log
+        self.push_updates = push_updates
 
         self.initialize_ui()
 
@@ -27,7 +31,8 @@ class MainWindow(tk.CTk):
         io_frame.pack(side=tk.LEFT, fill=tk.Y)
 
         #graph Frame
-        self.graph_page = GraphPage(self)
+        self.graph_page = GraphPage(self, valkey_log=self.valkey_log, push=self.push_updates,
+                                    sample_rate=self.app_settings.poll_rate_hz)
         self.graph_page.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
         # Box 1: Autotune Start Button
@@ -104,9 +109,22 @@ class MainWindow(tk.CTk):
         self.status_textbox = tk.CTkTextbox(status_frame, height=10)
         self.status_textbox.pack(pady=5, padx=5, fill="both", expand=True)
 
+        # Box 4: Devices shown on the graph
+        devices_frame = tk.CTkFrame(io_frame)
+        devices_frame.grid(row=3, column=0, padx=5, pady=10)
+
+        devices_label = tk.CTkLabel(devices_frame, text="Graph Devices")
+        devices_label.pack(padx=5, pady=5, expand=True)
+
+        self.devices_entry = tk.CTkEntry(devices_frame, placeholder_text="IDs, comma separated (all)")
+        self.devices_entry.pack(pady=5, expand=True)
+
+        show_devices_button = tk.CTkButton(devices_frame, text="Show Devices", command=self.show_devices)
+        show_devices_button.pack(pady=5, expand=True)
+
         # Stop Button
         stop_frame = tk.CTkFrame(io_frame)
-        stop_frame.grid(row=3, column=0)
+        stop_frame.grid(row=4, column=0)
 
         stop_button = tk.CTkButton(stop_frame, text="Stop", command=self.stop_command)
         stop_button.pack(pady=5)
@@ -128,6 +146,17 @@ class MainWindow(tk.CTk):
 
         self.start_cycle_callback(high_temp, low_temp, use_prct, prct_threshold, t_btw_switch, nb_cycle)
 
+    def show_devices(self):
+        """
+        Plots the devices typed in the entry, or every device that logged samples when it's empty.
+        """
+        if self.graph_page.valkey_log is None:
+            return  # Still starting up
+        devices = [device.strip() for device in self.devices_entry.get().split(",") if device.strip()]
+        if not devices:
+            devices = self.graph_page.valkey_log.list_devices()
+        self.graph_page.set_devices(devices)
+
     def update_pid_values(self, p, i, d):
         self.current_p_value.configure(text=f"Current P Value: {p}")
         self.current_i_value.configure(text=f"Current I Value: {i}")
@@ -11,6 +11,57 @@ class AppSettings:
 
         self.settings_folder = os.path.join(self.project_root, "..", "Settings")
 
+        # Controller engine ticks (sensor reads and logged samples) per second
+        self.poll_rate_hz = 1.0
+
+        # Redraw the graph when the controllers publish new samples instead of polling Valkey every second
+        self.push_graph_updates = True
+
+        # Serial port discovery: (vid, pid) of the controllers' USB adapters (empty = any USB serial
+        # adapter), probe timeout in seconds, whether a port must answer a `$REG` query to be used,
+        # and the file remembering the ports that answered last time
+        self.controller_usb_ids = set()
+        self.port_probe_timeout = 0.5
+        self.confirm_ports = True
+        self.port_cache_path = os.path.join(self.settings_folder, "last_ports.json")
+
+        # Valkey server spawned by the application, clients connect through the Unix socket when set
+        self.valkey_host = "127.0.0.1"
+        self.valkey_port = 6379
+        self.valkey_db = 0
+        self.valkey_socket_path = os.path.normpath(os.path.join(self.db_folder, "valkey.sock"))
+
+        # Where samples are logged: "valkey", "journal" (local append-only files, no server needed)
+        # or "auto" (Valkey, falling back to the journal when the server can't be reached at start)
+        self.storage_backend = "auto"
+        self.journal_folder = os.path.join(self.project_root, "..", "Data", "Journal")
+
+        # How samples are stored in Valkey: "hash" (one hash per sample), "stream" (one stream
+        # entry per sample) or "binary" (packed 17-byte records appended to hourly blobs)
+        self.storage_mode = "hash"
+
+        # Seconds the raw samples and the 10 s / 1 min / 10 min rollups are kept in Valkey,
+        # None keeps them until the run is evicted
+        self.raw_retention_s = None
+        self.rollup_retention_s = None
+
+        # Latency instrumentation of the engine loop: recording on or off, port of the local
+        # Prometheus endpoint (http://127.0.0.1:<port>/metrics, None = no endpoint), and interval
+        # in seconds of the summary printed to the log (None = no summary)
+        self.metrics_enabled = True
+        self.metrics_port = None
+        self.metrics_log_interval = 300
+
+        # Every autotune or cycle session is a run with its own keys in Valkey. Its samples are
+        # checkpointed in the background to CSV files in `archive_folder/run=<id>/` every
+        # `checkpoint_interval_s` seconds. Finished runs are archived ("csv", or "parquet" also
+        # exported to the `archive_folder/parquet/` dataset) and evicted from Valkey
+        # `run_retention_s` seconds later (None keeps them in Valkey)
+        self.export_format = "csv"
+        self.archive_folder = os.path.join(self.project_root, "..", "Data", "Archive")
+        self.checkpoint_interval_s = 10
+        self.run_retention_s = 0
+
     def get_db_path(self):
         return self.db_path
     @staticmethod
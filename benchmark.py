@@ -0,0 +1,221 @@
+"""
+Throughput and latency benchmarks of the acquisition, logging, graph and export paths.
+
+Runs against the simulated controller (Devices/simulator.py) and a Valkey server, no hardware
+needed. Every result is appended as one JSON line to the output file, tagged with the git
+commit, so runs of different versions can be compared:
+
+    python benchmark.py --db 15 --output bench_output.txt
+    python benchmark.py --only graph,export --export-sizes 100000,1000000
+
+The Valkey database given with --db is used as scratch space and emptied by the
+benchmarks, don't point it at the one holding real runs.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from Devices.controller import TemperatureController
+from Devices.simulator import SimulatedController
+from utils.Export import export_csv, export_parquet
+from utils.ValkeyFuncs import ValkeyLog, WriteBehindLog
+
+BENCHMARKS = ("tick", "logging", "graph", "export")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def latency_stats(durations):
+    """
+    :param durations: Measured durations, in seconds.
+    :returns: A dict of summary statistics, in milliseconds.
+    """
+    durations = np.asarray(durations) * 1000
+    return {
+        "count": len(durations),
+        "mean_ms": float(durations.mean()),
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p99_ms": float(np.percentile(durations, 99)),
+        "max_ms": float(durations.max()),
+    }
+
+
+def bench_tick(args):
+    """
+    End-to-end engine tick: sensor reads over the pty, cycle logic and queuing of the sample.
+    """
+    results = []
+    valkey_log = WriteBehindLog(ValkeyLog(port=args.port, db=args.db, mode="stream"))
+    for latency in (0.0, 0.005, 0.02):
+        simulator = SimulatedController(latency=latency)
+        controller = TemperatureController(simulator.start(), poll_rate=args.rate, valkey_log=valkey_log)
+        controller.connection()
+        controller.engine_running = True
+        controller.tick()  # Setup (fan, PID gains) isn't part of the steady state
+
+        controller.high_temp, controller.low_temp = 80, 40
+        controller.time_btw_switchover = 1
+        controller.wanted_nb_cycle = 1000
+        controller.start_cycle = True
+
+        durations = []
+        controller.scheduler.reset()
+        for _ in range(args.ticks):
+            controller.scheduler.wait()
+            start = time.perf_counter()
+            controller.tick()
+            durations.append(time.perf_counter() - start)
+
+        controller.ser.close()
+        simulator.close()
+        results.append({"benchmark": "tick", "device_latency_s": latency, "poll_rate_hz": args.rate,
+                        "serial_retries": controller.serial_retries, **latency_stats(durations)})
+    valkey_log.close()
+    return results
+
+
+def bench_logging(args):
+    """
+    Samples per second written to Valkey, through `log_many` directly and through the
+    write-behind queue, in every storage mode.
+    """
+    results = []
+    for mode in ("hash", "stream", "binary"):
+        valkey_log = ValkeyLog(port=args.port, db=args.db, mode=mode)
+        valkey_log.purge()
+        now = time.time()
+        samples = [(now + n, 20 + n % 50, 21 + n % 50) for n in range(args.samples)]
+
+        memory_before = valkey_log.r.info("memory")["used_memory"]
+        start = time.perf_counter()
+        for first in range(0, len(samples), 1000):
+            valkey_log.log_many(samples[first:first + 1000])
+        elapsed = time.perf_counter() - start
+        memory = valkey_log.r.info("memory")["used_memory"] - memory_before
+        results.append({"benchmark": "logging", "path": "log_many", "mode": mode, "samples": len(samples),
+                        "seconds": elapsed, "samples_per_s": len(samples) / elapsed,
+                        "bytes_per_sample": memory / len(samples)})
+        valkey_log.purge()
+
+        write_behind = WriteBehindLog(valkey_log, max_pending=len(samples))
+        start = time.perf_counter()
+        for timestamp, sensor_d, sensor_a in samples:
+            write_behind.log(sensor_d, sensor_a, timestamp=timestamp)
+        write_behind.close(timeout=600)
+        elapsed = time.perf_counter() - start
+        results.append({"benchmark": "logging", "path": "write_behind", "mode": mode, "samples": len(samples),
+                        "written": write_behind.written, "dropped": write_behind.dropped,
+                        "seconds": elapsed, "samples_per_s": write_behind.written / elapsed})
+        valkey_log.purge()
+    return results
+
+
+def bench_graph(args):
+    """
+    Frame time of the live graph against the length of the displayed window, for a full
+    redraw and for a blitted one. The graph's own LivePlot is driven like in push mode, on an
+    off-screen canvas: every frame is one pushed sample and `update_graph`.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from GUI.graph import SAMPLE_RATE_HZ, LivePlot
+
+    results = []
+    # No rollup tiers, the raw samples are drawn whatever the window length
+    valkey_log = ValkeyLog(port=args.port, db=args.db, rollup_tiers=())
+    valkey_log.purge()
+    for minutes in (5, 30, 120, 600, 1440):
+        for blit in (False, True):
+            figure = Figure(figsize=(8, 4), dpi=100)
+            plot = LivePlot(figure, FigureCanvasAgg(figure), valkey_log, last_minutes=minutes, blit=blit,
+                            push=True, sample_rate=SAMPLE_RATE_HZ)
+            # Fill the window, as if it had been backfilled
+            buffer = plot.series[0].buffer
+            start_time = time.time() - minutes * 60
+            for n in range(int(minutes * 60 * SAMPLE_RATE_HZ)):
+                buffer.append(start_time + n / SAMPLE_RATE_HZ, 50 + 30 * np.sin(n / 300), 48 + 30 * np.sin(n / 310))
+            plot.update_graph()  # First full draw, caches the background in blit mode
+
+            durations = []
+            for frame in range(args.frames):
+                frame_start = time.perf_counter()
+                plot.push_samples([(None, time.time(), 50, 48)])
+                durations.append(time.perf_counter() - frame_start)
+
+            results.append({"benchmark": "graph", "window_minutes": minutes, "samples": len(buffer),
+                             "blit": blit, **latency_stats(durations)})
+    return results
+
+
+def bench_export(args):
+    """
+    Export time against the number of logged samples, CSV and Parquet (when pyarrow is installed).
+    """
+    results = []
+    for mode, size in [(mode, size) for mode in ("stream", "binary") for size in args.export_sizes]:
+        valkey_log = ValkeyLog(port=args.port, db=args.db, mode=mode)
+        valkey_log.purge()
+        now = time.time() - size
+        for first in range(0, size, 10000):
+            valkey_log.log_many([(now + n, 20 + n % 50, 21 + n % 50) for n in range(first, min(size, first + 10000))])
+
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            export_csv(valkey_log, os.path.join(folder, "export.csv"), batch_size=10000)
+            elapsed = time.perf_counter() - start
+            results.append({"benchmark": "export", "format": "csv", "mode": mode, "samples": size,
+                            "seconds": elapsed, "samples_per_s": size / elapsed})
+
+            try:
+                start = time.perf_counter()
+                export_parquet(valkey_log, os.path.join(folder, "parquet"), run_id="bench", batch_size=10000)
+                elapsed = time.perf_counter() - start
+                results.append({"benchmark": "export", "format": "parquet", "mode": mode, "samples": size,
+                                "seconds": elapsed, "samples_per_s": size / elapsed})
+            except RuntimeError as e:
+                print(f"Skipping the Parquet export: {e}")
+    valkey_log.purge()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caramat benchmarks")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="Comma separated benchmarks to run")
+    parser.add_argument("--output", default="bench_output.txt", help="File the JSON lines are appended to")
+    parser.add_argument("--port", type=int, default=6379, help="Port of the Valkey server")
+    parser.add_argument("--db", type=int, default=15, help="Scratch Valkey database, emptied by the benchmarks")
+    parser.add_argument("--ticks", type=int, default=200, help="Engine ticks measured per device latency")
+    parser.add_argument("--rate", type=float, default=20.0, help="Engine ticks per second in the tick benchmark")
+    parser.add_argument("--samples", type=int, default=100000, help="Samples written by the logging benchmark")
+    parser.add_argument("--frames", type=int, default=50, help="Frames drawn per window length")
+    parser.add_argument("--export-sizes", default="100000,1000000,10000000",
+                        help="Comma separated numbers of samples exported")
+    args = parser.parse_args()
+    args.export_sizes = [int(float(size)) for size in args.export_sizes.split(",")]
+
+    run = {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    functions = {"tick": bench_tick, "logging": bench_logging, "graph": bench_graph, "export": bench_export}
+    with open(args.output, "a") as output:
+        for name in args.only.split(","):
+            for result in functions[name](args):
+                result.update(run)
+                print(json.dumps(result))
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+
+if __name__ == "__main__":
+    main()
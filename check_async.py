@@ -0,0 +1,100 @@
+"""
+End-to-end check of the asyncio controller (Devices/async_controller.py) over a pty.
+
+Drives AsyncTemperatureController against the simulated controller (Devices/simulator.py),
+whose port is a `pty.openpty()` pair, so the non-blocking transport is exercised on a real
+file descriptor: register reads and writes, a whole high/low cycle, and the loss of the port
+(the simulator side of the pty is closed) which must fail the pending command at once instead
+of waiting for its timeouts. Samples go to a journal in a temporary folder, no hardware or
+Valkey server needed:
+
+    python check_async.py
+
+Exits with status 1 when a check fails.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from Devices.async_controller import AsyncTemperatureController
+from Devices.protocol import ConnectionLost
+from Devices.simulator import SimulatedController
+from utils.Journal import JournalLog
+from utils.ValkeyFuncs import WriteBehindLog
+
+SPEEDUP = 200  # The simulated heater runs this many times faster than real time
+
+failures = []
+
+
+def check(name, condition, detail=""):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+    if not condition:
+        failures.append(name)
+
+
+async def check_registers(controller, simulator):
+    values = await controller.read_registers([68, 65])
+    check("sensors read", values == {68: simulator.ambient, 65: simulator.ambient}, values)
+    await controller.write_registers({4: 35})
+    check("setpoint written", simulator.registers[4] == 35, simulator.registers[4])
+
+
+async def check_cycle(controller, simulator, timeout=20):
+    controller.high_temp, controller.low_temp = 30, 25
+    controller.time_btw_switchover = 0.5
+    controller.use_percentage, controller.percentage_threshold = True, 95  # The model only approaches its target
+    controller.wanted_nb_cycle = 2
+    controller.cycle_io()
+    deadline = time.monotonic() + timeout
+    while controller.engine_running and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    check("cycle completed", not controller.engine_running and not controller.cycle_mode,
+          controller.status_callback)
+    check("heater off after the cycle", simulator.registers[2] == 0, simulator.registers[2])
+    await controller.engine_task
+
+
+async def check_connection_lost(controller, simulator):
+    simulator.stop()
+    os.close(simulator.master)
+    start = time.monotonic()
+    try:
+        await controller.read_registers([68])
+        check("lost port detected", False, "the read succeeded")
+    except ConnectionLost as e:
+        elapsed = time.monotonic() - start
+        check("lost port detected", True, e)
+        check("pending read failed at once", elapsed < controller.response_timeout, f"{elapsed:.3f} s")
+    try:
+        await controller.write_registers({4: 20})
+        check("later commands fail", False, "the write succeeded")
+    except ConnectionLost:
+        check("later commands fail", True)
+    os.close(simulator.slave)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as folder:
+        journal = JournalLog(folder, run_id="check")
+        valkey_log = WriteBehindLog(journal)
+        simulator = SimulatedController(clock=lambda: time.monotonic() * SPEEDUP)
+        controller = AsyncTemperatureController(simulator.start(), poll_rate=20, response_timeout=0.5,
+                                                valkey_log=valkey_log)
+        await controller.connection()
+        try:
+            await check_registers(controller, simulator)
+            await check_cycle(controller, simulator)
+            valkey_log.close()
+            check("samples logged", journal.count_samples() > 0, journal.count_samples())
+            await check_connection_lost(controller, simulator)
+        finally:
+            controller.transport.close()
+            journal.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+    sys.exit(1 if failures else 0)
@@ -1,21 +1,51 @@
-import serial
+import time
+START_TIME = time.perf_counter()  # Taken before the other imports, see report_first_frame
+
 import os
+import socket
 from Settings.app_settings import AppSettings
-from utils.PortDetection import list_serial_ports
-from Devices.controller import TemperatureController
 from GUI.ui import MainWindow
 import subprocess
-from utils.ValkeyFuncs import ValkeyLog
-import pandas as pd
+import queue
+import threading
+from utils.Events import EVENT_PID, EVENT_SAMPLE, EVENT_STATUS, EventBus
+from utils.Metrics import metrics
+from utils.Runs import ArchiveInterrupted, RunArchiver, RunRegistry
+
+# The serial, redis and numpy based modules (port discovery, controllers, sample logs) are
+# imported by the startup worker, in the background, so they don't delay the first frame.
 
 class Application:
     def __init__(self):
         self.app_settings = AppSettings()
-        self.controller = None
+        self.valkey_log = None  # ValkeyLog or JournalLog, chosen by open_sample_log once the server is started
+        self.runs = None  # RunRegistry of the autotune and cycle sessions logged to it
+        self.archiver = None  # RunArchiver writing the finished runs to disk, Valkey only
+        self.manager = None
         self.window = None
         self.valkey_process = None
         self.valkey_db = None
-        self.valkey_log = ValkeyLog()
+
+        # Status messages produced by worker threads, shown by the Tk thread
+        self.status_queue = queue.Queue()
+        # Samples, status and PID changes published by the controller engines
+        self.events = EventBus()
+        self.shutdown_thread = None
+        self.shutdown_success = None
+
+        # Set by startup_worker, then handed to the window by finish_startup
+        self.startup_thread = None
+        self.valkey_started = False
+        self.valkey_ok = True
+        self.device_ids = []
+        self.finished_run = None  # Log of the last run ended in this session, finalized at shutdown
+
+        # Run starts, ends and annotations, applied in order by run_worker off the Tk thread
+        self.run_tasks = queue.Queue()
+        self.run_thread = None
+        self.run_active = False  # A run was begun and not ended yet, as seen from the Tk thread
+        # Calls the workers hand to the Tk thread, e.g. pointing the graph at a new run
+        self.tk_calls = queue.Queue()
 
     def create_valkey_config(self):
         # Define the path for the Valkey config file
@@ -28,139 +58,496 @@ class Application:
         # Ensure the database directory exists
         os.makedirs(db_dir, exist_ok=True)
 
-        # Create the Valkey config file with default settings
-        with open(valkey_config_path, 'w') as config_file:
-            # Directory and DB filename
-            config_file.write(f"dir {db_dir}\n")
-            config_file.write(f"dbfilename {db_filename}\n")
+        # Directory and DB filename
+        config = f"dir {db_dir}\n"
+        config += f"dbfilename {db_filename}\n"
+
+        # Default IP and port settings
+        config += f"bind {self.app_settings.valkey_host}\n"
+        config += f"port {self.app_settings.valkey_port}\n"
+        if self.app_settings.valkey_socket_path:
+            config += f"unixsocket {self.app_settings.valkey_socket_path}\n"
+            config += "unixsocketperm 700\n"
 
-            # Default IP and port settings
-            config_file.write("bind 127.0.0.1\n")
-            config_file.write("port 6379\n")
+        # Optional log file path
+        log_dir = os.path.join(db_dir, "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        log_file = os.path.join(log_dir, "valkey.log")
+        config += f"logfile {log_file}\n"
 
-            # Optional log file path
-            log_dir = os.path.join(db_dir, "logs")
-            os.makedirs(log_dir, exist_ok=True)
-            log_file = os.path.join(log_dir, "valkey.log")
-            config_file.write(f"logfile {log_file}\n")
+        # Default memory settings
+        config += "maxmemory 0\n"
+        config += "databases 16\n"
+        config += "save 300 1\n"
 
-            # Default memory settings
-            config_file.write("maxmemory 0\n")
-            config_file.write("databases 16\n")
-            config_file.write("save 300 1\n")
+        # Only rewrite the config file when the settings changed
+        try:
+            with open(valkey_config_path) as config_file:
+                unchanged = config_file.read() == config
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            with open(valkey_config_path, 'w') as config_file:
+                config_file.write(config)
 
         return valkey_config_path
 
     def start_valkey_process(self):
+        """
+        Starts the Valkey server, unless one already answers on the configured socket or port,
+        in which case it is reused and left running at exit.
+
+        :returns: False when the server couldn't be started.
+        """
+        if self.ping_valkey():
+            print("Reusing the Valkey server already running")
+            return True
+
         valkey_config_path = self.create_valkey_config()
         valkey_server_path = "/usr/bin/valkey-server"
 
         try:
             self.valkey_process = subprocess.Popen([valkey_server_path, valkey_config_path])
-        except Exception:
-            self.window.show_valkey_warning_popup()
-
-    def transfer_valkey_to_csv(self):
-        try:
-            keys =  self.valkey_log.r.keys('data_*')
-            data_list = []
-            for key in keys:
-                data = self.valkey_log.r.hgetall(key)
-                data = {k.decode(): v.decode() for k, v in data.items()}
-                data_list.append(data)
-
-            df = pd.DataFrame(data_list)
-            df.to_csv("valkey_data.csv", index=False)
             return True
-        except:
+        except Exception as e:
+            print(f"Error starting the Valkey server: {e}")
             return False
 
-    def purge_valkey_db(self):
+    def valkey_socket_path(self):
+        """
+        Unix socket the clients connect through, None to use TCP: a server started elsewhere
+        (e.g. the system service) usually has no socket, or not this one.
+        """
+        socket_path = self.app_settings.valkey_socket_path
+        return socket_path if socket_path and os.path.exists(socket_path) else None
+
+    def ping_valkey(self, timeout=0.2):
         """
-        Purge the Valkey database by deleting all `data_*` keys.
+        Sends a raw PING to the configured server, without going through the shared client and
+        its retries, over the same transport as the clients (see valkey_socket_path).
+
+        :returns: True when the server answered PONG. A server still loading its dump answers
+            with an error and isn't ready yet.
         """
         try:
-            keys = self.valkey_log.r.keys('data_*')
-            self.valkey_log.r.delete(*keys)
-            return True
-        except:
+            socket_path = self.valkey_socket_path()
+            if socket_path:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(timeout)
+                connection.connect(socket_path)
+            else:
+                connection = socket.create_connection((self.app_settings.valkey_host, self.app_settings.valkey_port),
+                                                      timeout=timeout)
+            with connection:
+                connection.sendall(b"PING\r\n")
+                return connection.recv(64).startswith(b"+PONG")
+        except OSError:
             return False
 
-    def controller_connection(self):
-        available_ports = list_serial_ports()
+    def wait_for_valkey(self, deadline=5.0, first_delay=0.01, max_delay=0.5):
+        """
+        Waits for the server to accept commands, probing it with a delay doubling from
+        `first_delay` up to `max_delay`, so a fast start is noticed within milliseconds.
+
+        :param deadline: Seconds after which the server is given up on.
+        :returns: True when the server answered a PING.
+        """
+        give_up = time.monotonic() + deadline
+        delay = first_delay
+        while True:
+            if self.ping_valkey():
+                return True
+            if self.valkey_process is not None and self.valkey_process.poll() is not None:
+                print(f"The Valkey server exited with code {self.valkey_process.returncode}")
+                return False
+            if time.monotonic() + delay > give_up:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def open_sample_log(self, valkey_ready):
+        """
+        Chooses where the samples are logged, according to the `storage_backend` setting, and
+        creates the controller manager writing to it.
+
+        :param valkey_ready: Whether the Valkey server answers.
+        :returns: False when "auto" had to fall back to the local journal.
+        """
+        from Devices.manager import ControllerManager
+        from utils.Journal import JournalLog
+        from utils.ValkeyFuncs import ValkeyLog
+
+        backend = self.app_settings.storage_backend
+        if backend in ("valkey", "auto"):
+            valkey_log = ValkeyLog(host=self.app_settings.valkey_host, port=self.app_settings.valkey_port,
+                                   db=self.app_settings.valkey_db,
+                                   unix_socket_path=self.valkey_socket_path(),
+                                   mode=self.app_settings.storage_mode,
+                                   raw_retention=self.app_settings.raw_retention_s,
+                                   rollup_retention=self.app_settings.rollup_retention_s)
+            if backend == "valkey" or valkey_ready:
+                self.valkey_log = valkey_log
+        fell_back = self.valkey_log is None and backend == "auto"
+        if self.valkey_log is None:
+            self.valkey_log = JournalLog(self.app_settings.journal_folder)
+
+        self.manager = ControllerManager(poll_rate=self.app_settings.poll_rate_hz, valkey_log=self.valkey_log,
+                                         events=self.events)
+
+        self.runs = RunRegistry(self.valkey_log)
+        self.run_thread = threading.Thread(target=self.run_worker, daemon=True)
+        self.run_thread.start()
+        try:
+            for run_id in self.runs.recover():
+                self.report_status(f"Run {run_id} was interrupted, it will be archived")
+        except Exception as e:
+            print(f"Error recovering the runs: {e}")
+        if isinstance(self.valkey_log, ValkeyLog):
+            # Journals are already on disk, only Valkey runs need archiving
+            self.archiver = RunArchiver(self.runs, self.app_settings.archive_folder,
+                                        export_format=self.app_settings.export_format,
+                                        retention=self.app_settings.run_retention_s,
+                                        interval=self.app_settings.checkpoint_interval_s,
+                                        status_callback=self.report_status)
+            self.archiver.start()
+        return not fell_back
+
+    def report_status(self, message):
+        """
+        Queue a message for the status box. Safe to call from any thread.
+        """
+        print(message)
+        self.status_queue.put(message)
+
+    def drain_status_queue(self):
+        """
+        Show the queued status messages and the events published by the controllers, and close
+        the window once the shutdown worker is done. Runs on the Tk thread every 100 ms.
+        """
+        while True:
+            try:
+                message = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.window.update_status(message)
+        while True:
+            try:
+                call = self.tk_calls.get_nowait()
+            except queue.Empty:
+                break
+            call()
+
+        if self.startup_thread and not self.startup_thread.is_alive():
+            self.startup_thread = None
+            self.finish_startup()
+
+        samples = []
+        several_devices = len(self.device_ids) > 1
+        for event in self.events.drain():
+            prefix = f"[{event.device}] " if event.device is not None and several_devices else ""
+            if event.kind == EVENT_SAMPLE:
+                samples.append((event.device,) + tuple(event.payload))
+            elif event.kind == EVENT_STATUS and event.payload:
+                self.window.update_status(prefix + event.payload)
+            elif event.kind == EVENT_PID:
+                self.window.update_pid_values(*event.payload)
+                self.annotate_run(pid_gains=self.pid_gains())
+        if samples and self.app_settings.push_graph_updates:
+            self.window.graph_page.push_samples(samples)
+
+        # The run ends when every controller has stopped (stop button, cycle or autotune over).
+        # While closing, shutdown_worker ends it once the queued samples are written.
+        if (self.run_active and not self.shutdown_thread
+                and not any(c.engine_running for c in self.controllers())):
+            self.end_run()
+
+        if self.shutdown_thread and not self.shutdown_thread.is_alive():
+            self.shutdown_thread = None
+            if self.shutdown_success:
+                self.window.destroy()
+                return
+            self.window.update_status("Shutdown failed, data kept in Valkey.")
+
+        self.window.after(100, self.drain_status_queue)
+
+    def pid_gains(self):
+        """
+        Last PID gains read from every controller, by device ID.
+        """
+        return {controller.device_id: (controller.r5_gain_value, controller.r6_gain_value, controller.r7_gain_value)
+                for controller in self.controllers()}
+
+    def run_worker(self):
+        """
+        Applies the queued run changes in order, so the Tk thread never waits on Valkey for
+        them. Exits on None, queued by shutdown_worker.
+        """
+        while True:
+            task = self.run_tasks.get()
+            if task is None:
+                return
+            function, args = task
+            function(*args)
+
+    def begin_run(self, kind, settings=None):
+        """
+        Starts a new run: the samples logged from now on go to its own keys, and the graph follows it.
+        Only queues it, see start_run.
+
+        :param kind: "autotune" or "cycle".
+        :param settings: Dict of the settings of the session, kept in the run metadata.
+        """
+        self.run_active = True
+        self.run_tasks.put((self.start_run, (kind, settings, self.pid_gains())))
+
+    def end_run(self):
+        """
+        Ends the active run, only queues it, see finish_run.
+        """
+        self.run_active = False
+        self.run_tasks.put((self.finish_run, ()))
+
+    def annotate_run(self, **fields):
+        self.run_tasks.put((self.update_run, (fields,)))
+
+    def start_run(self, kind, settings, pid_gains):
+        """
+        run_worker side of begin_run, the previous run is finished first.
+        """
+        self.finish_run()
+        try:
+            run_log = self.runs.begin(kind, settings, pid_gains)
+        except Exception as e:
+            print(f"Error starting a run: {e}")
+            return
+        self.manager.valkey_log.set_target(run_log)
+        self.tk_calls.put(lambda: self.window.graph_page.set_source(run_log, self.device_ids or None))
+        self.report_status(f"Started run {run_log.run_id}")
+
+    def finish_run(self):
+        """
+        Marks the active run as finished, the archiver writes it to disk in the background.
+        The samples logged from now on go back to the main keyspace. Called by run_worker, and
+        by shutdown_worker once it has stopped.
 
+        :returns: The log of the finished run, None when no run was active.
+        """
+        if self.manager and self.runs and self.runs.current:
+            # The run gets its queued samples and last rollup buckets before it's marked finished,
+            # the archiver could evict it right after
+            if not self.manager.valkey_log.set_target(self.valkey_log, timeout=2):
+                print("The last samples of the run are still queued")
+        try:
+            run_log = self.runs.finish()
+        except Exception as e:
+            print(f"Error finishing the run: {e}")
+            return None
+        if run_log is not None:
+            self.finished_run = run_log
+            self.report_status(f"Finished run {run_log.run_id}")
+        return run_log
+
+    def update_run(self, fields):
+        try:
+            self.runs.annotate(**fields)
+        except Exception as e:
+            print(f"Error updating the run: {e}")
+
+    def discover_ports(self):
+        """
+        Serial ports a controller answers on.
+        """
+        from utils.PortDetection import discover_controller_ports
+
+        return discover_controller_ports(cache_path=self.app_settings.port_cache_path,
+                                         usb_ids=self.app_settings.controller_usb_ids,
+                                         timeout=self.app_settings.port_probe_timeout,
+                                         confirm=self.app_settings.confirm_ports)
+
+    def controller_connection(self, available_ports):
+        """
+        Attaches a controller to every port found and starts polling them.
+
+        :returns: The IDs of the attached devices, empty when none could be attached.
+        """
         if not available_ports:
-            return False
+            return []
+
+        device_ids = self.manager.attach_all(available_ports)
+        if device_ids:
+            self.manager.start()
+        return device_ids
+
+    def startup_worker(self):
+        """
+        Everything slow at startup, run off the Tk thread while the window is already shown:
+        the port discovery runs alongside the Valkey start and readiness probe, then the
+        controllers found are attached to the sample log. finish_startup completes the startup
+        on the Tk thread.
+        """
+        available_ports = []
+        discovery = threading.Thread(target=lambda: available_ports.extend(self.discover_ports()), daemon=True)
+        discovery.start()
 
-        controller_port = available_ports[0]
         try:
-            self.controller = TemperatureController(port=controller_port)
-            self.controller.connection()
-            return True
-        except serial.SerialException:
-            return False
+            use_valkey = self.app_settings.storage_backend != "journal"
+            self.valkey_started = use_valkey and self.start_valkey_process()
+            self.valkey_ok = self.open_sample_log(self.valkey_started and self.wait_for_valkey())
+
+            discovery.join()
+            self.device_ids = self.controller_connection(available_ports)
+        except Exception as e:
+            print(f"Error during startup: {e}")
+
+    def finish_startup(self):
+        """
+        Hands the sample log to the graph and reports what the startup worker couldn't do.
+        Runs on the Tk thread.
+        """
+        if self.manager is None:
+            self.report_status("Startup failed, see the log.")
+            return
+        try:
+            source = self.runs.latest() or self.valkey_log
+        except Exception as e:
+            print(f"Error listing the runs: {e}")
+            source = self.valkey_log
+        self.window.valkey_log = source
+        self.window.graph_page.set_source(source, self.device_ids or None)
+        elapsed = time.perf_counter() - START_TIME
+        metrics.observe("startup_ready_seconds", elapsed)
+        print(f"Started in {elapsed:.2f} s")
+
+        if self.app_settings.storage_backend != "journal" and not self.valkey_started:
+            self.window.show_valkey_warning_popup()
+        if not self.valkey_ok:
+            self.report_status(f"Valkey unavailable, logging to {self.valkey_log.run_folder()}")
+        if not self.device_ids:
+            self.window.show_warning_popup()
+
+    def report_first_frame(self):
+        """
+        Records the time from the start of the process to the first frame of the window.
+        """
+        elapsed = time.perf_counter() - START_TIME
+        metrics.observe("startup_first_frame_seconds", elapsed)
+        print(f"First frame after {elapsed:.2f} s")
+
+    def controllers(self):
+        if self.manager is None:
+            return []  # Still starting up
+        return list(self.manager.controllers.values())
 
     def start_autotune(self):
-        if self.controller:
-            self.controller.start_autotune_io()
+        if self.controllers():
+            self.begin_run("autotune")
+            for controller in self.controllers():
+                controller.start_autotune_io()
         else:
             self.window.show_warning_popup()
 
     def send_pid_values(self, p, i, d):
-        if self.controller:
-            self.controller.new_p_value = float(p)
-            self.controller.new_i_value = float(i)
-            self.controller.new_d_value = float(d)
-            self.controller.write_pid_values()
+        if self.controllers():
+            for controller in self.controllers():
+                controller.new_p_value = float(p)
+                controller.new_i_value = float(i)
+                controller.new_d_value = float(d)
+                controller.write_pid_values()
         else:
             self.window.show_warning_popup()
 
     def start_cycle(self, high_temp, low_temp, use_prct, prct_threshold, t_btw_switch, nb_cycle):
-        if self.controller:
-            self.controller.high_temp = high_temp
-            self.controller.low_temp = low_temp
-            self.controller.use_percentage = use_prct
-            self.controller.percentage_threshold = prct_threshold
-            self.controller.time_btw_switchover = t_btw_switch
-            self.controller.wanted_nb_cycle = nb_cycle
-            self.controller.start_cycle_io()
+        if self.controllers():
+            self.begin_run("cycle", {'high_temp': high_temp, 'low_temp': low_temp, 'use_percentage': use_prct,
+                                     'percentage_threshold': prct_threshold, 'time_btw_switchover': t_btw_switch,
+                                     'nb_cycle': nb_cycle, 'poll_rate_hz': self.app_settings.poll_rate_hz})
+            for controller in self.controllers():
+                controller.high_temp = high_temp
+                controller.low_temp = low_temp
+                controller.use_percentage = use_prct
+                controller.percentage_threshold = prct_threshold
+                controller.time_btw_switchover = t_btw_switch
+                controller.wanted_nb_cycle = nb_cycle
+                controller.cycle_io()
         else:
             self.window.show_warning_popup()
 
     def stop(self):
-        if self.controller:
-            self.controller.shut_down()
+        if self.controllers():
+            for controller in self.controllers():
+                controller.shut_down()
         else:
             self.window.show_warning_popup()
 
+    def start_metrics(self):
+        """
+        Applies the instrumentation settings: recording on or off, HTTP endpoint and periodic summary.
+        """
+        metrics.enabled = self.app_settings.metrics_enabled
+        if not metrics.enabled:
+            return
+        if self.app_settings.metrics_port:
+            try:
+                metrics.serve(self.app_settings.metrics_port)
+            except OSError as e:
+                print(f"Error starting the metrics endpoint: {e}")
+        if self.app_settings.metrics_log_interval:
+            metrics.log_summary_every(self.app_settings.metrics_log_interval)
+
     def run(self):
-        self.start_valkey_process()
+        self.start_metrics()
+        # The window comes up right away, the graph is built once the sample log is open
         self.window = MainWindow(self.app_settings, self.start_autotune, self.send_pid_values, self.stop,
-                                 self.start_cycle)
+                                 self.start_cycle, push_updates=self.app_settings.push_graph_updates)
+        self.window.after_idle(self.report_first_frame)
+        self.report_status("Starting...")
 
-        if not self.controller_connection():
-            self.window.show_warning_popup()
+        self.startup_thread = threading.Thread(target=self.startup_worker, daemon=True)
+        self.startup_thread.start()
 
         self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.window.after(100, self.drain_status_queue)
         self.window.mainloop()
 
     def on_closing(self):
-        if self.controller:
-            shutdown_success = self.controller.shut_down()
-            if shutdown_success:
-                convert_to_csv = self.transfer_valkey_to_csv()
-                if convert_to_csv:
-                    purge_valkey_db = self.purge_valkey_db()
-                    if purge_valkey_db:
-                        if self.valkey_process:
-                            kill_valkey = self.valkey_process.terminate()
-                            if kill_valkey:
-                                self.window.destroy()
-                        else:
-                            self.window.destroy()
-            else:
+        if self.shutdown_thread:
+            return  # Already shutting down
+        if self.startup_thread:
+            self.report_status("Still starting up, try again in a moment.")
+            return
+        if self.manager is None:
+            self.window.destroy()  # The startup failed, nothing was logged
+            return
+        if self.controllers():
+            shutdown_success = all([controller.shut_down() for controller in self.controllers()])
+            if not shutdown_success:
                 return  # Prevent closing if shutdown fails
 
+        # Drain the log off the Tk thread, drain_status_queue closes the window when done
+        self.report_status("Closing...")
+        self.shutdown_thread = threading.Thread(target=self.shutdown_worker, daemon=True)
+        self.shutdown_thread.start()
+
+    def shutdown_worker(self):
+        # Closing only waits for the samples still queued and the last checkpoint of the run.
+        # Other finished runs (and a Parquet export) are archived by the next session.
+        self.shutdown_success = self.manager.close()
+        # The run changes still queued are applied first
+        if self.run_thread:
+            self.run_tasks.put(None)
+            self.run_thread.join()
+        run_log = self.finish_run() or self.finished_run
+        if self.archiver:
+            stopped = self.archiver.stop()
+            if run_log is not None and self.shutdown_success and stopped:
+                try:
+                    self.archiver.archive(run_log.run_id)
+                except ArchiveInterrupted:
+                    pass
+                except Exception as e:
+                    print(f"Error archiving the run: {e}")
+        if self.shutdown_success and self.valkey_process:
+            self.valkey_process.terminate()
 
 
 if __name__ == "__main__":
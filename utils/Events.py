@@ -0,0 +1,43 @@
+import queue
+import time
+from collections import namedtuple
+
+EVENT_SAMPLE = "sample"  # payload: (epoch_seconds, sensor_d, sensor_a)
+EVENT_STATUS = "status"  # payload: the status message
+EVENT_PID = "pid"  # payload: (p, i, d) gains read from the controller
+
+Event = namedtuple('Event', ['kind', 'device', 'payload', 'time'])
+
+
+class EventBus:
+    def __init__(self, max_pending=10000):
+        """
+        Thread-safe, in-process queue carrying live updates from the controller engines to the
+        GUI. Publishing never blocks: when the consumer falls behind, new events are dropped
+        and counted.
+
+        :param max_pending: Maximum number of events waiting to be drained.
+        """
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+
+    def publish(self, kind, device, payload):
+        try:
+            self.queue.put_nowait(Event(kind, device, payload, time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self, limit=1000):
+        """
+        Takes the pending events, without waiting.
+
+        :param limit: Maximum number of events returned, so one drain can't stall the caller.
+        :returns: A list of Event(kind, device, payload, time) tuples, oldest first.
+        """
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
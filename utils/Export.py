@@ -0,0 +1,159 @@
+import csv
+import datetime
+import math
+import os
+
+
+def format_timestamp(timestamp_ms):
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def format_value(value):
+    return "" if value is None or math.isnan(value) else value
+
+
+def export_csv(valkey_log, path="valkey_data.csv", batch_size=1000, progress_callback=None):
+    """
+    Stream every logged sample to a CSV file in time order.
+
+    Samples are fetched in pipelined batches and written as they arrive, so memory stays
+    bounded by `batch_size` whatever the length of the run. The file is written next to
+    `path` and only renamed over it once complete.
+
+    :param valkey_log: ValkeyLog to read the samples from.
+    :param path: Destination CSV file.
+    :param batch_size: Number of samples fetched per round trip.
+    :param progress_callback: Optional callable receiving (exported, total) after each batch.
+    :returns: The number of samples exported.
+    """
+    total = valkey_log.count_samples()
+    exported = 0
+    tmp_path = f"{path}.part"
+
+    with open(tmp_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['timestamp', 'sensor_a', 'sensor_d'])
+        for batch in valkey_log.iter_batches(batch_size):
+            writer.writerows((format_timestamp(timestamp_ms), format_value(sensor_a), format_value(sensor_d))
+                             for timestamp_ms, sensor_d, sensor_a in batch)
+            exported += len(batch)
+            if progress_callback:
+                progress_callback(exported, total)
+
+    os.replace(tmp_path, path)
+    return exported
+
+
+def append_csv(valkey_log, path, cursor=None, offset=0):
+    """
+    Append the samples logged since `cursor` to a CSV file, for incremental checkpoints.
+
+    The file is first cut back to `offset`, the size it had when the checkpoint `cursor` was
+    taken, so rows written after it (e.g. before a crash) aren't duplicated. The new rows
+    are flushed to the disk before returning.
+
+    :param valkey_log: ValkeyLog or JournalLog to read the samples from.
+    :param path: CSV file, created with its header when `offset` is 0.
+    :param cursor: Cursor returned by `valkey_log.fetch_since` at the last checkpoint, None to
+        start from the first sample.
+    :param offset: Size of the file at the last checkpoint.
+    :returns: A tuple (appended, cursor, offset) to pass to the next call.
+    """
+    if offset and (not os.path.exists(path) or os.path.getsize(path) < offset):
+        cursor, offset = None, 0  # The file was lost or cut short, write it again from the start
+    if cursor is None and valkey_log.mode == "hash":
+        cursor = 0  # From the first counter, not just the recent backfill
+    samples, cursor = valkey_log.fetch_since(cursor)
+
+    with open(path, 'a+', newline='') as csv_file:
+        csv_file.truncate(offset)
+        writer = csv.writer(csv_file)
+        if offset == 0:
+            writer.writerow(['timestamp', 'sensor_a', 'sensor_d'])
+        writer.writerows((format_timestamp(timestamp_ms), format_value(sensor_a), format_value(sensor_d))
+                         for timestamp_ms, sensor_d, sensor_a in samples)
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+        offset = csv_file.tell()
+    return len(samples), cursor, offset
+
+
+def export_parquet(valkey_log, folder="valkey_data", run_id=None, batch_size=1000, row_group_size=65536,
+                   progress_callback=None):
+    """
+    Stream every logged sample to typed Parquet files, partitioned per run and per day.
+
+    Files are laid out as `folder/run=<run_id>[/device=<id>]/date=<YYYY-MM-DD>/part-0.parquet`, with the
+    timestamp stored as int64 nanoseconds and both sensors as float32. Each row group carries
+    min/max statistics, so readers (pandas, pyarrow.dataset, DuckDB...) can push time-range
+    filters down and skip whole row groups.
+
+    :param valkey_log: ValkeyLog to read the samples from.
+    :param folder: Root folder of the dataset.
+    :param run_id: Name of the run partition, defaults to the time of the first sample.
+    :param batch_size: Number of samples fetched per round trip.
+    :param row_group_size: Number of rows buffered before a row group is written.
+    :param progress_callback: Optional callable receiving (exported, total) after each batch.
+    :returns: The number of samples exported.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow, install it with `pip install pyarrow`")
+
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('ns')),
+        ('sensor_d', pa.float32()),
+        ('sensor_a', pa.float32()),
+    ])
+    total = valkey_log.count_samples()
+    exported = 0
+    writer = None
+    day = None
+    rows = ([], [], [])
+
+    def flush():
+        if rows[0]:
+            timestamps, sensor_d, sensor_a = rows
+            writer.write_table(pa.table([pa.array(timestamps, pa.timestamp('ns')),
+                                         pa.array(sensor_d, pa.float32(), from_pandas=True),
+                                         pa.array(sensor_a, pa.float32(), from_pandas=True)], schema=schema))
+            for column in rows:
+                column.clear()
+
+    try:
+        for batch in valkey_log.iter_batches(batch_size):
+            for timestamp_ms, sensor_d, sensor_a in batch:
+                sample_day = datetime.date.fromtimestamp(timestamp_ms / 1000)
+                if sample_day != day:
+                    # New day, close the current partition and open the next one
+                    if writer:
+                        flush()
+                        writer.close()
+                    if run_id is None:
+                        run_id = datetime.datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y%m%d-%H%M%S")
+                    day = sample_day
+                    partition = os.path.join(folder, f"run={run_id}")
+                    if valkey_log.device is not None:
+                        partition = os.path.join(partition, f"device={valkey_log.device}")
+                    partition = os.path.join(partition, f"date={day.isoformat()}")
+                    os.makedirs(partition, exist_ok=True)
+                    writer = pq.ParquetWriter(os.path.join(partition, "part-0.parquet"), schema,
+                                              write_statistics=True)
+
+                rows[0].append(timestamp_ms * 1_000_000)
+                rows[1].append(sensor_d)
+                rows[2].append(sensor_a)
+                if len(rows[0]) >= row_group_size:
+                    flush()
+
+            exported += len(batch)
+            if progress_callback:
+                progress_callback(exported, total)
+    finally:
+        if writer:
+            flush()
+            writer.close()
+
+    return exported
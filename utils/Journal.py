@@ -0,0 +1,273 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from utils.Records import RECORD_DTYPE, pack, to_samples
+
+JOURNAL_MAGIC = b"CMJ1"
+HEADER_SIZE = 16  # Magic, record size (uint16 little endian), reserved
+JOURNAL_SUFFIX = ".journal"
+META_FILE = "meta.json"  # Metadata of the run, next to its journals
+
+
+class JournalLog:
+    def __init__(self, folder, run_id=None, device=None, fsync=True):
+        """
+        Sample log kept in local, append-only journal files instead of Valkey, with the same
+        interface as ValkeyLog so the controllers, the graph and the export work unchanged.
+
+        Each device of a run gets one file, `folder/run=<run_id>/samples[.<device>].journal`: a
+        16-byte header followed by fixed-width records (see utils.Records). Writers only ever
+        append whole batches, readers map the file with numpy.memmap, so reading never copies
+        or parses anything until samples are handed out. When a file is reopened after a crash,
+        a torn last record and trailing garbage (zeroed or out of order records) are cut off.
+
+        :param folder: Folder holding one subfolder per run.
+        :param run_id: Name of the run, defaults to the current time.
+        :param device: ID of the controller the samples come from, None for the untagged ones.
+        :param fsync: Flush every batch to the disk before returning, so a power loss loses
+            at most the batch being written.
+        """
+        self.folder = folder
+        self.run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+        self.device = device
+        self.fsync = fsync
+        self.mode = "journal"
+        self.rollup_tiers = ()  # No rollups, the graph reads the raw records
+        self.files = {}  # device -> file descriptor open for appending
+        self.lock = threading.Lock()
+
+    def run_folder(self):
+        return os.path.join(self.folder, f"run={self.run_id}")
+
+    def path(self, device=None):
+        """
+        Journal file of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        name = "samples" if device is None else f"samples.{device}"
+        return os.path.join(self.run_folder(), name + JOURNAL_SUFFIX)
+
+    @staticmethod
+    def recover(path):
+        """
+        Cuts a journal back to its last valid record: a partial record at the end, then any
+        trailing record that is zeroed (blocks allocated but never written) or older than the
+        one before it.
+
+        :raises ValueError: When the file isn't a journal.
+        :returns: The number of records kept.
+        """
+        with open(path, 'r+b') as journal:
+            header = journal.read(HEADER_SIZE)
+            if header[:4] != JOURNAL_MAGIC or int.from_bytes(header[4:6], 'little') != RECORD_DTYPE.itemsize:
+                raise ValueError(f"{path} isn't a sample journal")
+            size = os.fstat(journal.fileno()).st_size
+            count = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+
+            if count:
+                times = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))['t']
+                while count and (times[count - 1] == 0 or (count > 1 and times[count - 1] < times[count - 2])):
+                    count -= 1
+                del times
+
+            valid_size = HEADER_SIZE + count * RECORD_DTYPE.itemsize
+            if valid_size != size:
+                print(f"Recovered {path}: dropped {size - valid_size} bytes of torn records")
+                journal.truncate(valid_size)
+                journal.flush()
+                os.fsync(journal.fileno())
+        return count
+
+    def open_for_append(self, device):
+        path = self.path(device)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            self.recover(path)
+        else:
+            with open(path, 'wb') as journal:
+                journal.write(JOURNAL_MAGIC + RECORD_DTYPE.itemsize.to_bytes(2, 'little') + bytes(10))
+                journal.flush()
+                os.fsync(journal.fileno())
+        return os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def log(self, sensor_d, sensor_a):
+        """
+        Append one sample with the current time.
+        """
+        self.log_many([(time.time(), sensor_d, sensor_a)])
+
+    def log_many(self, samples, device=None):
+        """
+        Append a batch of samples with a single write.
+
+        :param samples: A list of (epoch_seconds, sensor_d, sensor_a[, state_flags]) tuples, in time order.
+        :param device: ID of the controller the samples come from, defaults to `self.device`.
+        """
+        if not samples:
+            return
+        device = self.device if device is None else device
+        data = pack(samples)
+        with self.lock:
+            fd = self.files.get(device)
+            if fd is None:
+                fd = self.files[device] = self.open_for_append(device)
+            os.write(fd, data)
+            if self.fsync:
+                os.fsync(fd)
+
+    def flush_rollups(self):
+        pass  # No rollups
+
+    def records(self):
+        """
+        Every record of `self.device` logged so far, mapped from the journal without copying.
+
+        :returns: A structured array with the fields t, d, a and flags.
+        """
+        path = self.path()
+        try:
+            count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        except OSError:
+            count = 0
+        if count <= 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def list_devices(self):
+        """
+        IDs of every controller that logged tagged samples in this run.
+        """
+        prefix = os.path.join(self.run_folder(), "samples.")
+        return sorted(path[len(prefix):-len(JOURNAL_SUFFIX)]
+                      for path in glob.glob(prefix + "*" + JOURNAL_SUFFIX))
+
+    def for_device(self, device):
+        """
+        A JournalLog of the same run, bound to another device.
+        """
+        return JournalLog(self.folder, self.run_id, device=device, fsync=self.fsync)
+
+    def for_run(self, run_id):
+        """
+        A JournalLog bound to another run, in the same folder.
+        """
+        return JournalLog(self.folder, run_id, device=self.device, fsync=self.fsync)
+
+    def list_runs(self):
+        """
+        IDs of every run with metadata in the folder, oldest first.
+        """
+        prefix = os.path.join(self.folder, "run=")
+        paths = glob.glob(os.path.join(prefix + "*", META_FILE))
+        return [os.path.dirname(path)[len(prefix):] for path in sorted(paths, key=os.path.getmtime)]
+
+    def save_run_meta(self, meta):
+        """
+        Add or update fields of the metadata of the run, written to `meta.json` in the run folder.
+
+        :param meta: Dict of str values.
+        """
+        path = os.path.join(self.run_folder(), META_FILE)
+        os.makedirs(self.run_folder(), exist_ok=True)
+        merged = dict(self.load_run_meta(), **meta)
+        with open(path + ".part", 'w') as meta_file:
+            json.dump(merged, meta_file, indent=2)
+        os.replace(path + ".part", path)
+
+    def load_run_meta(self):
+        try:
+            with open(os.path.join(self.run_folder(), META_FILE)) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def to_ms(bound):
+        if hasattr(bound, "timestamp"):
+            return int(bound.timestamp() * 1000)
+        return int(bound)
+
+    def fetch_range(self, start=None, end=None, count=None):
+        """
+        Fetch the samples logged in a time window, located by binary search in the journal.
+
+        :param start: Start of the window as a datetime or epoch-ms, None for the first sample.
+        :param end: End of the window as a datetime or epoch-ms, None for the last sample.
+        :param count: Optional maximum number of samples to return.
+        :returns: A list of (epoch_ms, sensor_d, sensor_a) tuples ordered by time.
+        """
+        records = self.records()
+        first = 0 if start is None else int(np.searchsorted(records['t'], self.to_ms(start), side='left'))
+        stop = len(records) if end is None else int(np.searchsorted(records['t'], self.to_ms(end), side='right'))
+        if count is not None:
+            stop = min(stop, first + count)
+        return to_samples(records[first:stop])
+
+    def fetch_records_since(self, cursor=None, start=None):
+        """
+        Fetch the records appended after `cursor` as one structured array.
+
+        :param cursor: Cursor returned by the previous call (number of records read), None on the first call.
+        :param start: On the first call, ignore records older than this datetime or epoch-ms.
+        :returns: A tuple (records, cursor).
+        """
+        records = self.records()
+        if cursor is None:
+            cursor = 0 if start is None else int(np.searchsorted(records['t'], self.to_ms(start), side='left'))
+        elif len(records) < cursor:
+            cursor = 0  # The journal has been replaced since the last call
+        return records[cursor:], len(records)
+
+    def fetch_since(self, cursor=None, start=None, backfill=3600, batch_size=1000):
+        """
+        Same as ValkeyLog.fetch_since, `backfill` and `batch_size` are unused.
+        """
+        records, cursor = self.fetch_records_since(cursor, start)
+        return to_samples(records), cursor
+
+    def count_samples(self):
+        return len(self.records())
+
+    def iter_batches(self, batch_size=1000):
+        """
+        Walk every logged sample in time order, one batch at a time.
+
+        :returns: A generator of lists of (epoch_ms, sensor_d, sensor_a) tuples.
+        """
+        records = self.records()
+        for first in range(0, len(records), batch_size):
+            yield to_samples(records[first:first + batch_size])
+
+    def close(self):
+        with self.lock:
+            for fd in self.files.values():
+                os.close(fd)
+            self.files = {}
+
+    def purge(self, batch_size=1000, progress_callback=None):
+        """
+        Delete the journals and the metadata of this run.
+
+        :returns: The number of files removed.
+        """
+        self.close()
+        removed = 0
+        for path in glob.glob(os.path.join(self.run_folder(), "*" + JOURNAL_SUFFIX)):
+            os.remove(path)
+            removed += 1
+            if progress_callback:
+                progress_callback(removed)
+        try:
+            os.remove(os.path.join(self.run_folder(), META_FILE))
+        except OSError:
+            pass
+        try:
+            os.rmdir(self.run_folder())
+        except OSError:
+            pass
+        return removed
@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds, from 100 µs to 2.5 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Fixed-bucket histogram of durations, cheap enough to be updated on every tick.
+
+        :param buckets: Sorted upper bounds of the buckets, a last +Inf bucket is added.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the `q` quantile, inf when it's past the last bound.
+        """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return float("nan")
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class TimedLock:
+    __slots__ = ("lock", "wait", "hold", "acquired")
+
+    def __init__(self, lock, wait, hold):
+        self.lock = lock
+        self.wait = wait
+        self.hold = hold
+        self.acquired = None
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.wait.observe(self.acquired - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Measured before the release, the next holder may already be waiting
+        self.hold.observe(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        """
+        Registry of the latency histograms and counters of the acquisition pipeline.
+
+        Every series is identified by its name and its labels (e.g. device, stage). When
+        disabled, timers and counters are no-ops and nothing is recorded.
+
+        :param enabled: Whether measurements are recorded.
+        """
+        self.enabled = enabled
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def timer(self, name, **labels):
+        """
+        Context manager recording the duration of its block in the `name` histogram.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self.histogram(name, **labels))
+
+    def locked(self, lock, name, **labels):
+        """
+        Acquires `lock` like a `with lock:` block, recording the time spent waiting for it in
+        `<name>_wait_seconds` and the time it was held in `<name>_hold_seconds`.
+        """
+        if not self.enabled:
+            return lock
+        return TimedLock(lock, self.histogram(f"{name}_wait_seconds", **labels),
+                         self.histogram(f"{name}_hold_seconds", **labels))
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def render(self):
+        """
+        :returns: Every series in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            with histogram.lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        :returns: One human readable line per series: count, mean and approximate p50/p99.
+        """
+        lines = [f"{name}{self.format_labels(labels)} {value}" for (name, labels), value
+                 in sorted(self.counters.items(), key=lambda item: item[0])]
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if histogram.count == 0:
+                continue
+            lines.append(f"{name}{self.format_labels(labels)} count={histogram.count} "
+                         f"mean={histogram.sum / histogram.count * 1000:.2f}ms "
+                         f"p50<={histogram.quantile(0.5) * 1000:g}ms p99<={histogram.quantile(0.99) * 1000:g}ms")
+        return "\n".join(lines)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serves `render()` on http://host:port/metrics from a background thread.
+
+        :returns: The HTTP server, `shutdown()` stops it.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # No line printed per scrape
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def log_summary_every(self, interval):
+        """
+        Prints `summary()` every `interval` seconds from a background thread.
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                if self.enabled:
+                    print(self.summary())
+
+        threading.Thread(target=loop, daemon=True).start()
+
+
+# Shared by the controllers, the manager and the Valkey writer, switched on or off by the application
+metrics = Metrics()
@@ -1,7 +1,13 @@
 import sys
 import glob
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import serial
 
+from Devices.protocol import STATUS_OK, parse_reply
+
 
 def list_serial_ports():
     """ Lists serial port names
@@ -28,3 +34,96 @@ def list_serial_ports():
         except (OSError, serial.SerialException):
             pass
     return result
+
+
+def candidate_ports(usb_ids=None):
+    """ Lists the ports that can be a controller, from the OS metadata only (nothing is opened)
+
+        Ports without USB metadata (virtual consoles, onboard UARTs) are left out.
+
+        :param usb_ids:
+            Optional set of (vid, pid) tuples, only the matching USB adapters are kept
+        :returns:
+            A list of port names
+    """
+    from serial.tools import list_ports
+
+    result = []
+    for info in list_ports.comports():
+        if info.vid is None:
+            continue
+        if usb_ids and (info.vid, info.pid) not in usb_ids:
+            continue
+        result.append(info.device)
+    return result
+
+
+def probe_port(port, baudrate=115200, timeout=0.5, confirm=True):
+    """ Checks that a port opens and, optionally, that a controller answers on it
+
+        :param port:
+            The port to probe
+        :param timeout:
+            Read and write timeout of the probe, in seconds
+        :param confirm:
+            Send a `$REG 1` query and only accept the port if a register reply comes back
+        :returns:
+            True when the port is usable
+    """
+    try:
+        with serial.Serial(port, baudrate, timeout=timeout, write_timeout=timeout) as s:
+            if not confirm:
+                return True
+            s.reset_input_buffer()
+            s.write(b"$REG 1\r\n")
+            return parse_reply(s.read_until(b"\r\n")).status == STATUS_OK
+    except (OSError, serial.SerialException):
+        return False
+
+
+def load_cached_ports(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return []
+
+
+def save_cached_ports(cache_path, ports):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as cache_file:
+            json.dump(ports, cache_file)
+    except OSError:
+        pass
+
+
+def discover_controller_ports(cache_path=None, usb_ids=None, timeout=0.5, confirm=True, max_workers=8):
+    """ Finds the ports a controller answers on, quickly
+
+        Candidates come from the USB metadata of the ports plus the ports that answered last
+        time, and are all probed in parallel with short timeouts.
+
+        :param cache_path:
+            JSON file remembering the ports that answered, for the next start
+        :param usb_ids:
+            Optional set of (vid, pid) tuples of the controllers' USB adapters
+        :param timeout:
+            Timeout of each probe, in seconds
+        :param confirm:
+            Only accept ports on which a controller answers a `$REG` query
+        :returns:
+            A list of port names, the previously known good ones first
+    """
+    cached = load_cached_ports(cache_path) if cache_path else []
+    candidates = list(dict.fromkeys(cached + candidate_ports(usb_ids)))
+    if not candidates:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(candidates))) as executor:
+        answers = list(executor.map(lambda port: probe_port(port, timeout=timeout, confirm=confirm), candidates))
+
+    result = [port for port, answered in zip(candidates, answers) if answered]
+    if cache_path:
+        save_cached_ports(cache_path, result)
+    return result
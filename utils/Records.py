@@ -0,0 +1,66 @@
+import numpy as np
+
+# One sample, packed without padding: epoch-ms, sensor D, sensor A and flags (17 bytes)
+RECORD_DTYPE = np.dtype([('t', '<u8'), ('d', '<f4'), ('a', '<f4'), ('flags', 'u1')])
+
+FLAG_D_MISSING = 1 << 0  # Sensor D couldn't be read, stored as NaN
+FLAG_A_MISSING = 1 << 1  # Sensor A couldn't be read, stored as NaN
+FLAG_CYCLE = 1 << 2  # A temperature cycle was running
+CYCLE_STEP_SHIFT = 3  # Bits 3 to 5 hold the phase of the cycle step (Devices.profile, 0 to 5)
+CYCLE_STEP_MASK = 0b111 << CYCLE_STEP_SHIFT
+FLAG_AUTOTUNE = 1 << 6  # An autotune was running
+
+# Decoded float32 values are rounded to this many decimals, their precision for temperatures
+DECODE_DECIMALS = 4
+
+
+def state_flags(cycle_mode, cycle_step, autotune):
+    """
+    Flags describing the controller state when a sample was taken.
+
+    :param cycle_mode: Whether a temperature cycle is running.
+    :param cycle_step: Phase of the running cycle step (`switchover_callback`).
+    :param autotune: Whether an autotune is running.
+    """
+    flags = FLAG_AUTOTUNE if autotune else 0
+    if cycle_mode:
+        flags |= FLAG_CYCLE | ((int(cycle_step) << CYCLE_STEP_SHIFT) & CYCLE_STEP_MASK)
+    return flags
+
+
+def pack(samples):
+    """
+    Encode samples as consecutive fixed-width records.
+
+    :param samples: A list of (epoch_seconds, sensor_d, sensor_a) or (epoch_seconds, sensor_d,
+        sensor_a, state_flags) tuples, missing readings being None.
+    :returns: The records as bytes, `len(samples) * RECORD_DTYPE.itemsize` long.
+    """
+    records = np.empty(len(samples), dtype=RECORD_DTYPE)
+    for index, sample in enumerate(samples):
+        timestamp, sensor_d, sensor_a = sample[:3]
+        flags = sample[3] if len(sample) > 3 else 0
+        if sensor_d is None:
+            flags |= FLAG_D_MISSING
+        if sensor_a is None:
+            flags |= FLAG_A_MISSING
+        records[index] = (int(timestamp * 1000), np.nan if sensor_d is None else sensor_d,
+                          np.nan if sensor_a is None else sensor_a, flags)
+    return records.tobytes()
+
+
+def unpack(data):
+    """
+    Zero-copy view of a blob of records as a structured array with fields t, d, a and flags.
+    """
+    return np.frombuffer(data, dtype=RECORD_DTYPE, count=len(data) // RECORD_DTYPE.itemsize)
+
+
+def to_samples(records):
+    """
+    Convert records to the (epoch_ms, sensor_d, sensor_a) tuples returned by the ValkeyLog
+    readers, missing readings being NaN.
+    """
+    sensor_d = np.round(records['d'].astype(np.float64), DECODE_DECIMALS)
+    sensor_a = np.round(records['a'].astype(np.float64), DECODE_DECIMALS)
+    return list(zip(records['t'].tolist(), sensor_d.tolist(), sensor_a.tolist()))
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class SampleRingBuffer:
+    def __init__(self, capacity):
+        """
+        Preallocated, fixed-capacity buffer of (epoch seconds, sensor D, sensor A) samples.
+
+        Every sample is written twice, at `i` and `i + capacity`, so the samples currently held
+        are always one contiguous slice of the arrays: `times`, `sensor_d` and `sensor_a`
+        return ordered views without copying anything.
+
+        :param capacity: Maximum number of samples kept, the oldest ones are overwritten.
+        """
+        self.capacity = max(1, int(capacity))
+        self._times = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._sensor_d = np.zeros(2 * self.capacity, dtype=np.float32)
+        self._sensor_a = np.zeros(2 * self.capacity, dtype=np.float32)
+        self.start = 0  # Index of the oldest sample in [0, capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, sensor_d, sensor_a):
+        """
+        Add one sample, overwriting the oldest one when the buffer is full.
+
+        :param timestamp: Epoch seconds of the sample.
+        :param sensor_d: Sensor D value, None for a failed reading.
+        :param sensor_a: Sensor A value, None for a failed reading.
+        """
+        index = (self.start + self.size) % self.capacity
+        for array, value in ((self._times, timestamp), (self._sensor_d, sensor_d), (self._sensor_a, sensor_a)):
+            value = np.nan if value is None else value
+            array[index] = value
+            array[index + self.capacity] = value
+
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def evict_before(self, timestamp):
+        """
+        Drop every sample older than `timestamp` (epoch seconds).
+        """
+        evicted = int(np.searchsorted(self.times, timestamp, side='left'))
+        self.start = (self.start + evicted) % self.capacity
+        self.size -= evicted
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    @property
+    def times(self):
+        return self._times[self.start:self.start + self.size]
+
+    @property
+    def sensor_d(self):
+        return self._sensor_d[self.start:self.start + self.size]
+
+    @property
+    def sensor_a(self):
+        return self._sensor_a[self.start:self.start + self.size]
+
+    def y_limits(self, default=(0, 100)):
+        """
+        Vectorized min/max over both sensors, ignoring missing readings.
+
+        :returns: A (min, max) tuple, `default` when the buffer holds no valid value.
+        """
+        if self.size == 0:
+            return default
+        low = min(np.nanmin(self.sensor_d, initial=np.inf), np.nanmin(self.sensor_a, initial=np.inf))
+        high = max(np.nanmax(self.sensor_d, initial=-np.inf), np.nanmax(self.sensor_a, initial=-np.inf))
+        if not np.isfinite(low) or not np.isfinite(high):
+            return default
+        if low == high:
+            return low - 1, high + 1
+        return float(low), float(high)
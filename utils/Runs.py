@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+import time
+
+from utils.Export import append_csv, export_parquet
+
+RUN_ACTIVE = "active"  # Samples are being logged
+RUN_FINISHED = "finished"  # Stopped, waiting to be archived
+RUN_ARCHIVED = "archived"  # Written to disk, evicted from Valkey once past the retention
+
+
+class ArchiveInterrupted(Exception):
+    """
+    The archiver was stopped while a run was being written, it is archived again next time.
+    """
+
+
+class RunRegistry:
+    def __init__(self, sample_log):
+        """
+        Keeps track of the runs: every autotune or cycle session logs to its own keyspace (see
+        `ValkeyLog.for_run` and `JournalLog.for_run`), with metadata describing it: kind,
+        settings, PID gains, start and stop times, and archival status.
+
+        :param sample_log: ValkeyLog or JournalLog the runs are derived from.
+        """
+        self.sample_log = sample_log
+        self.current = None  # Log of the active run
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_run_id(kind):
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}"
+
+    def begin(self, kind, settings=None, pid_gains=None):
+        """
+        Finishes the active run, if any, and starts a new one.
+
+        :param kind: What the run is, e.g. "autotune" or "cycle".
+        :param settings: Dict of the settings of the run, stored as JSON.
+        :param pid_gains: Dict mapping device IDs to their (p, i, d) gains at the start.
+        :returns: The log of the new run.
+        """
+        self.finish()
+        run_log = self.sample_log.for_run(self.new_run_id(kind))
+        run_log.save_run_meta({
+            'kind': kind,
+            'status': RUN_ACTIVE,
+            'started': repr(time.time()),
+            'settings': json.dumps(settings or {}),
+            'pid_gains': json.dumps(pid_gains or {}),
+        })
+        with self.lock:
+            self.current = run_log
+        return run_log
+
+    def annotate(self, **fields):
+        """
+        Adds fields to the metadata of the active run, values are stored as JSON.
+        """
+        with self.lock:
+            run_log = self.current
+        if run_log is not None:
+            run_log.save_run_meta({name: json.dumps(value) for name, value in fields.items()})
+
+    def finish(self):
+        """
+        Marks the active run as finished, does nothing when no run is active.
+
+        :returns: The log of the finished run, None when no run was active.
+        """
+        with self.lock:
+            run_log, self.current = self.current, None
+        if run_log is not None:
+            run_log.save_run_meta({'status': RUN_FINISHED, 'stopped': repr(time.time())})
+        return run_log
+
+    def recover(self):
+        """
+        Marks the runs left active by a previous session (crash, power cut) as finished, so
+        they get archived.
+
+        :returns: The IDs of the runs recovered.
+        """
+        recovered = []
+        for run_id, meta in self.runs(RUN_ACTIVE):
+            run_log = self.sample_log.for_run(run_id)
+            run_log.save_run_meta({'status': RUN_FINISHED, 'stopped': meta.get('stopped', ""), 'interrupted': "1"})
+            recovered.append(run_id)
+        return recovered
+
+    def runs(self, status=None):
+        """
+        :param status: Only list the runs with this status, None lists them all.
+        :returns: A list of (run_id, metadata) tuples, oldest first.
+        """
+        runs = []
+        for run_id in self.sample_log.list_runs():
+            meta = self.sample_log.for_run(run_id).load_run_meta()
+            if status is None or meta.get('status') == status:
+                runs.append((run_id, meta))
+        return runs
+
+    def latest(self):
+        """
+        The log of the active run, or of the most recent one, None when there is no run yet.
+        """
+        with self.lock:
+            if self.current is not None:
+                return self.current
+        run_ids = self.sample_log.list_runs()
+        return self.sample_log.for_run(run_ids[-1]) if run_ids else None
+
+
+class RunArchiver:
+    def __init__(self, registry, folder, export_format="csv", retention=0, interval=10, settle=5,
+                 status_callback=None):
+        """
+        Background worker writing the runs to disk and evicting the finished ones from Valkey,
+        so Valkey only holds the active run (plus the archived runs still within `retention`),
+        and closing the application doesn't wait for an export.
+
+        Each run is written to `folder/run=<run_id>/`, one `samples[_<device>].csv` per device
+        and `meta.json`. The CSV files are checkpoints: every `interval` seconds, the samples
+        logged since the last pass are appended to them and flushed to the disk, then the
+        high-water mark (read cursor and file size) is saved in the run metadata. After a
+        crash or a restart, checkpointing resumes exactly from it. Archiving a finished run is
+        then only a last checkpoint, plus the Parquet export when that format is chosen. The
+        Parquet dataset has its own root, `folder/parquet/run=<run_id>/`, so the CSV and JSON
+        files don't get in the way of the dataset readers.
+
+        :param registry: RunRegistry of the runs to archive.
+        :param folder: Root folder of the archive.
+        :param export_format: "csv" or "parquet".
+        :param retention: Seconds an archived run stays in Valkey, None keeps them.
+        :param interval: Seconds between two checkpoints.
+        :param settle: Seconds a run must have been finished before it is archived, so the samples
+            still queued by the write-behind log when it ended are in.
+        :param status_callback: Optional callable receiving progress messages.
+        """
+        self.registry = registry
+        self.folder = folder
+        self.export_format = export_format
+        self.retention = retention
+        self.interval = interval
+        self.settle = settle
+        self.status_callback = status_callback
+        self.stopping = False
+        self.event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stops the worker, interrupting the run being archived.
+
+        :returns: True when the worker exited in time.
+        """
+        self.stopping = True
+        self.event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def loop(self):
+        while not self.stopping:
+            try:
+                with self.registry.lock:
+                    active = self.registry.current
+                if active is not None:
+                    self.checkpoint(active)
+                self.archive_finished()
+                self.evict_expired()
+            except ArchiveInterrupted:
+                return
+            except Exception as e:
+                print(f"Error archiving runs: {e}")
+            self.event.wait(self.interval)
+            self.event.clear()
+
+    def report(self, message):
+        print(message)
+        if self.status_callback:
+            self.status_callback(message)
+
+    def check_stopping(self, exported, total):
+        if self.stopping:
+            raise ArchiveInterrupted()
+
+    def archive_finished(self):
+        for run_id, meta in self.registry.runs(RUN_FINISHED):
+            if float(meta.get('stopped') or 0) + self.settle <= time.time():
+                self.archive(run_id)
+
+    def checkpoint(self, run_log):
+        """
+        Appends the samples of every device of a run logged since its last checkpoint to its
+        CSV files, then saves the new high-water marks.
+
+        :returns: The number of samples appended.
+        """
+        run_folder = os.path.join(self.folder, f"run={run_log.run_id}")
+        os.makedirs(run_folder, exist_ok=True)
+        meta = run_log.load_run_meta()
+        appended = 0
+        for device in run_log.list_devices() or [None]:
+            field = "checkpoint" if device is None else f"checkpoint:{device}"
+            mark = json.loads(meta.get(field) or '{"cursor": null, "offset": 0}')
+            name = "samples.csv" if device is None else f"samples_{device}.csv"
+            count, cursor, offset = append_csv(run_log.for_device(device), os.path.join(run_folder, name),
+                                               mark['cursor'], mark['offset'])
+            # Saved once the rows are on the disk, a crash in between only rewrites them
+            run_log.save_run_meta({field: json.dumps({'cursor': cursor, 'offset': offset})})
+            appended += count
+        return appended
+
+    def archive(self, run_id):
+        """
+        Writes the last samples of a finished run to disk and marks it archived. With CSV, this
+        only appends what was logged since the last checkpoint.
+
+        :raises ArchiveInterrupted: When the archiver is stopped during the Parquet export.
+        """
+        run_log = self.registry.sample_log.for_run(run_id)
+        if run_log.load_run_meta().get('status') != RUN_FINISHED:
+            return  # Already archived (and maybe evicted), its CSV files are complete
+        run_folder = os.path.join(self.folder, f"run={run_id}")
+        self.checkpoint(run_log)
+        if self.export_format == "parquet":
+            for device in run_log.list_devices() or [None]:
+                export_parquet(run_log.for_device(device), os.path.join(self.folder, "parquet"), run_id=run_id,
+                               progress_callback=self.check_stopping)
+
+        meta = run_log.load_run_meta()
+        archived = {'status': RUN_ARCHIVED, 'archived': repr(time.time()), 'archive': run_folder}
+        with open(os.path.join(run_folder, "meta.json"), 'w') as meta_file:
+            json.dump(dict(meta, **archived), meta_file, indent=2)
+        run_log.save_run_meta(archived)
+        self.report(f"Archived run {run_id}")
+
+    def evict_expired(self):
+        """
+        Removes from Valkey the archived runs older than the retention.
+        """
+        if self.retention is None:
+            return
+        for run_id, meta in self.registry.runs(RUN_ARCHIVED):
+            if float(meta.get('archived', 0)) + self.retention <= time.time():
+                self.registry.sample_log.for_run(run_id).purge()
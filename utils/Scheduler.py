@@ -0,0 +1,118 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+from utils.Metrics import metrics
+
+
+class TickScheduler:
+    def __init__(self, rate_hz=1.0, history=3600, clock=time.monotonic, sleep=time.sleep, name="engine"):
+        """
+        Fixed-rate scheduler on the monotonic clock.
+
+        Ticks are due at absolute deadlines `start + n * period`, so the time spent in a tick
+        doesn't accumulate into drift, and wall-clock changes don't affect the rate. When a
+        tick overruns past one or more deadlines, those ticks are skipped instead of being
+        run back to back.
+
+        Every tick is also recorded in the metrics registry, labelled with `name`: its jitter in
+        `scheduler_jitter_seconds`, overruns in `scheduler_overruns_total` and skipped deadlines
+        in `scheduler_ticks_skipped_total`.
+
+        :param rate_hz: Number of ticks per second.
+        :param history: Number of recent ticks kept for the jitter percentiles.
+        :param name: Label of the scheduler in the metrics, e.g. the device it polls.
+        """
+        self.name = name
+        self.period = 1 / rate_hz
+        self.clock = clock
+        self.sleep = sleep
+        self.history = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        """
+        Restart the schedule from now and clear the statistics.
+        """
+        self.next_deadline = None
+        self.tick_time = None  # Deadline of the current tick, monotonic seconds
+        self.ticks = 0
+        self.overruns = 0  # Ticks that started after their deadline had passed
+        self.skipped = 0  # Deadlines missed entirely
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.history.clear()
+
+    def wait(self):
+        """
+        Sleep until the next deadline.
+
+        :returns: The deadline of the tick that starts, in monotonic seconds.
+        """
+        delay = self.delay()
+        if delay > 0:
+            self.sleep(delay)
+        return self.start_tick(late=delay < 0)
+
+    async def wait_async(self):
+        """
+        Same as `wait`, sleeping with asyncio so other tasks of the event loop keep running.
+        """
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.start_tick(late=delay < 0)
+
+    def delay(self):
+        """
+        Time left until the next deadline, negative when it has already passed.
+        """
+        now = self.clock()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        return self.next_deadline - now
+
+    def start_tick(self, late):
+        """
+        Records the start of the tick due at the next deadline.
+
+        :param late: True when the deadline had already passed before any sleep.
+        """
+        now = self.clock()
+        if late:
+            # The previous tick overran, skip the deadlines that have already passed
+            missed = math.floor((now - self.next_deadline) / self.period)
+            self.overruns += 1
+            self.skipped += missed
+            self.next_deadline += missed * self.period
+            metrics.increment("scheduler_overruns_total", scheduler=self.name)
+            if missed:
+                metrics.increment("scheduler_ticks_skipped_total", missed, scheduler=self.name)
+
+        jitter = now - self.next_deadline
+        self.ticks += 1
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.history.append(jitter)
+        metrics.observe("scheduler_jitter_seconds", jitter, scheduler=self.name)
+
+        self.tick_time = self.next_deadline
+        self.next_deadline += self.period
+        return self.tick_time
+
+    def stats(self):
+        """
+        Timing statistics since the last reset, jitter being how late a tick started after
+        its deadline, in seconds.
+        """
+        recent = sorted(self.history)
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'jitter_mean': self.jitter_sum / self.ticks if self.ticks else 0.0,
+            'jitter_max': self.jitter_max,
+            'jitter_p50': recent[len(recent) // 2] if recent else 0.0,
+            'jitter_p99': recent[min(len(recent) - 1, int(len(recent) * 0.99))] if recent else 0.0,
+        }
@@ -1,32 +1,871 @@
+import numpy as np
 import redis
 import datetime
+import threading
+import time
+import uuid
+from collections import deque
+
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+from utils.Metrics import metrics
+from utils.Records import RECORD_DTYPE, pack, to_samples, unpack
+
+ROLLUP_TIERS = (10, 60, 600)  # Bucket lengths of the rollup tiers, in seconds
+RUNS_KEY = "runs"  # Sorted set of the run IDs, scored by creation time
+
+# "hash" mode: reserves one counter per sample and writes their hashes in one atomic step, so
+# a reader never sees a counter whose hash isn't written yet.
+# KEYS[1]: counter of the device. ARGV: hash key prefix, device ('' for none), retention in seconds (0 for
+# none), then the timestamp, sensor A and sensor D of every sample.
+LOG_HASHES_SCRIPT = """
+local count = (#ARGV - 3) / 3
+local last = redis.call('INCRBY', KEYS[1], count)
+for i = 0, count - 1 do
+    local key = ARGV[1] .. (last - count + 1 + i)
+    redis.call('HSET', key, 'timestamp', ARGV[4 + 3 * i], 'sensor_a', ARGV[5 + 3 * i], 'sensor_d', ARGV[6 + 3 * i])
+    if ARGV[2] ~= '' then
+        redis.call('HSET', key, 'device', ARGV[2])
+    end
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('EXPIRE', key, ARGV[3])
+    end
+end
+return last
+"""
+
+clients = {}  # (host, port, db, unix socket path) -> shared redis.Redis
+
+
+class UnconfirmedBatch(Exception):
+    """
+    The reply to a batch timed out and whether it was applied couldn't be checked: writing it
+    again could duplicate it.
+    """
+
+clients_lock = threading.Lock()
+
+
+def get_client(host="localhost", port=6379, db=0, unix_socket_path=None, max_connections=16, socket_timeout=2.0,
+               health_check_interval=30):
+    """
+    Shared Valkey client of a server and database, created on first use.
+
+    Every ValkeyLog (the writer, the graph, the exports...) goes through the same bounded,
+    blocking connection pool instead of opening its own connections. Commands time out after
+    `socket_timeout`, idle connections are checked with a PING before reuse, and commands
+    failing on a dropped connection are retried on a fresh one with exponential backoff.
+    Timeouts aren't retried: the server may already have applied the command, see
+    `ValkeyLog.execute_batch`.
+
+    :param unix_socket_path: Connect through this Unix domain socket instead of TCP, faster
+        with the locally spawned server.
+    :param max_connections: Size of the pool, callers wait for a free connection beyond it.
+    :param socket_timeout: Timeout of connecting, of each command, and of waiting for a free
+        connection, in seconds.
+    :param health_check_interval: A connection idle for this many seconds is checked before use.
+    """
+    key = (host, port, db, unix_socket_path)
+    with clients_lock:
+        client = clients.get(key)
+        if client is None:
+            options = dict(db=db, max_connections=max_connections, timeout=socket_timeout,
+                           socket_timeout=socket_timeout, health_check_interval=health_check_interval,
+                           retry=Retry(ExponentialBackoff(cap=1.0, base=0.05), 3),
+                           retry_on_error=[redis.ConnectionError])
+            if unix_socket_path:
+                pool = redis.BlockingConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                                    path=unix_socket_path, **options)
+            else:
+                pool = redis.BlockingConnectionPool(host=host, port=port, socket_connect_timeout=socket_timeout,
+                                                    **options)
+            client = clients[key] = redis.Redis(connection_pool=pool)
+    return client
+
+
+class RollupBucket:
+    def __init__(self, start):
+        """
+        Running min/max/mean/last of both sensors over one rollup bucket.
+
+        :param start: Start of the bucket, in epoch seconds.
+        """
+        self.start = start
+        self.count = 0
+        # [min, max, sum, valid readings, last] per sensor, missing readings are skipped
+        self.d = [float("inf"), float("-inf"), 0.0, 0, None]
+        self.a = [float("inf"), float("-inf"), 0.0, 0, None]
+
+    def copy(self):
+        bucket = RollupBucket(self.start)
+        bucket.count = self.count
+        bucket.d = list(self.d)
+        bucket.a = list(self.a)
+        return bucket
+
+    def add(self, sensor_d, sensor_a):
+        self.count += 1
+        for stats, value in ((self.d, sensor_d), (self.a, sensor_a)):
+            if value is None:
+                continue
+            value = float(value)
+            if value != value:  # NaN
+                continue
+            stats[0] = min(stats[0], value)
+            stats[1] = max(stats[1], value)
+            stats[2] += value
+            stats[3] += 1
+            stats[4] = value
+
+    def fields(self):
+        """
+        The bucket as stream entry fields, empty values for a sensor without any valid reading.
+        """
+        data = {'n': self.count}
+        for name, stats in (('d', self.d), ('a', self.a)):
+            valid = stats[3] > 0
+            data[f'{name}min'] = repr(stats[0]) if valid else ""
+            data[f'{name}max'] = repr(stats[1]) if valid else ""
+            data[f'{name}mean'] = repr(stats[2] / stats[3]) if valid else ""
+            data[f'{name}last'] = repr(stats[4]) if valid else ""
+        return data
+
 
 class ValkeyLog:
-    def __init__(self, host="localhost", port=6379, db=0):
+    def __init__(self, host="localhost", port=6379, db=0, mode="hash", stream_key="data_stream", maxlen=None,
+                 device=None, rollup_tiers=ROLLUP_TIERS, raw_retention=None, rollup_retention=None,
+                 chunk_seconds=3600, unix_socket_path=None, run_id=None):
         """
         Initialize the Valkey connection, similar to Redis.
+
+        :param mode: "hash" stores every sample in its own hash, `data_{n}` (`data_sample:<device>:{n}`
+            for a tagged sample, each device counting its own samples), "stream" appends
+            every sample to a single time-ordered stream whose entry IDs are epoch-ms, "binary"
+            appends every sample as a 17-byte record (see utils.Records) to one blob per
+            `chunk_seconds`, listed by start time in a sorted set.
+        :param stream_key: Name of the stream used in "stream" mode (one per run).
+        :param maxlen: Optional approximate cap on the stream length, None keeps everything.
+        :param device: ID of the controller the samples come from. Samples are tagged with it
+            when logged, and readers only return the samples of that device (None for the
+            untagged ones). In "stream" mode each device gets its own stream.
+        :param rollup_tiers: Bucket lengths, in seconds, of the min/max/mean/last rollups kept up
+            to date as samples are logged, one stream per tier and device. Empty to disable.
+        :param raw_retention: Seconds the raw samples are kept, None keeps them all.
+        :param rollup_retention: Seconds the rollup buckets are kept, None keeps them all.
+        :param chunk_seconds: Time span of one blob in "binary" mode.
+        :param unix_socket_path: Reach the server through this Unix socket instead of host:port.
+        :param run_id: Run the samples belong to. Every key of a run is prefixed with
+            `run:<run_id>:`, so runs never mix and one run can be evicted on its own. None uses
+            the unprefixed keys.
         """
+        if mode not in ("hash", "stream", "binary"):
+            raise ValueError(f"Unknown storage mode: {mode}")
         self.host = host
         self.port = port
         self.db = db
-        self.r = redis.Redis(host=self.host, port=self.port, db=self.db)
+        self.mode = mode
+        self.stream_key = stream_key
+        self.maxlen = maxlen
+        self.device = device
+        self.rollup_tiers = tuple(sorted(rollup_tiers))
+        self.raw_retention = raw_retention
+        self.rollup_retention = rollup_retention
+        self.chunk_seconds = chunk_seconds
+        self.open_rollups = {}  # (device, tier) -> RollupBucket not written yet
+        self.stream_last_ms = {}  # Stream key -> epoch-ms of its last entry, see log_many
+        self.unix_socket_path = unix_socket_path
+        self.run_id = run_id
+        self.prefix = "" if run_id is None else f"run:{run_id}:"
+        self.r = get_client(self.host, self.port, self.db, self.unix_socket_path)
+        self.log_hashes = self.r.register_script(LOG_HASHES_SCRIPT)
 
     def log(self, sensor_d, sensor_a):
         """
-        Log sensor data with a timestamp in Valkey.
+        Log one sample with the current time, written like a batch of one (see log_many).
+        """
+        self.log_many([(time.time(), sensor_d, sensor_a)])
+
+    def log_many(self, samples, device=None):
+        """
+        Log a batch of samples in pipelined round trips.
+
+        Each batch is written in one MULTI/EXEC transaction, so a batch that failed was not
+        applied at all and can be written again without duplicating records or rollup buckets.
+        When the reply times out, the batch marker set by the transaction tells whether it was
+        applied (see `execute_batch`).
+
+        :param samples: A list of (epoch_seconds, sensor_d, sensor_a) tuples, in time order.
+            A fourth element, the state flags of utils.Records, is stored in "binary" mode.
+        :param device: ID of the controller the samples come from, defaults to `self.device`.
+        :raises UnconfirmedBatch: When the reply timed out and the marker couldn't be read.
+        """
+        if not samples:
+            return
+        device = self.device if device is None else device
+
+        pipe = self.r.pipeline(transaction=True)
+        if device is not None:
+            pipe.sadd(self.key("data_devices"), device)
+        marker = uuid.uuid4().hex
+        pipe.set(self.batch_key(device), marker)
+
+        if self.mode == "stream":
+            key = self.sample_key(device)
+            last_ms = self.stream_last_ms.get(key)
+            if last_ms is None:
+                last = self.r.xrevrange(key, count=1)
+                last_ms = int(last[0][0].split(b"-")[0]) if last else 0
+            for timestamp, sensor_d, sensor_a, *_ in samples:
+                # Explicit epoch-ms IDs keep the sample time, the server adds the sequence number.
+                # They are clamped to the last ID, which the server rejects going below (e.g.
+                # after the wall clock stepped back).
+                last_ms = max(last_ms, int(timestamp * 1000))
+                data = {'d': self.encode_value(sensor_d), 'a': self.encode_value(sensor_a)}
+                pipe.xadd(key, data, id=f"{last_ms}-*", maxlen=self.maxlen, approximate=True)
+            self.trim_raw(pipe, device)
+            rollups = self.update_rollups(pipe, samples, device)
+            self.execute_batch(pipe, device, marker)
+            self.stream_last_ms[key] = last_ms
+            self.open_rollups.update(rollups)
+            return
+
+        if self.mode == "binary":
+            chunks = {}
+            for sample in samples:
+                chunks.setdefault(self.chunk_start(sample[0]), []).append(sample)
+            index_key = self.chunk_index_key(device)
+            for start, chunk_samples in chunks.items():
+                # APPEND is atomic, readers always see whole records
+                pipe.append(self.chunk_key(start, device), pack(chunk_samples))
+                pipe.zadd(index_key, {start: start})
+                if self.raw_retention:
+                    pipe.expireat(self.chunk_key(start, device), int(start + self.chunk_seconds + self.raw_retention))
+            if self.raw_retention:
+                pipe.zremrangebyscore(index_key, "-inf", f"({time.time() - self.raw_retention - self.chunk_seconds}")
+            rollups = self.update_rollups(pipe, samples, device)
+            self.execute_batch(pipe, device, marker)
+            self.open_rollups.update(rollups)
+            return
+
+        # Reserve one counter per sample and write their hashes atomically
+        args = [self.hash_key("", device), "" if device is None else device, int(self.raw_retention or 0)]
+        for timestamp, sensor_d, sensor_a, *_ in samples:
+            # Millisecond precision, several samples are logged per second above 1 Hz
+            args += [datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                     self.encode_value(sensor_a), self.encode_value(sensor_d)]
+        self.log_hashes(keys=[self.counter_key(device)], args=args, client=pipe)
+        rollups = self.update_rollups(pipe, samples, device)
+        self.execute_batch(pipe, device, marker)
+        self.open_rollups.update(rollups)
+
+    def execute_batch(self, pipe, device, marker):
+        """
+        Runs the transaction of a batch. When its reply times out, the server may still have
+        applied it: the batch is then considered written when the marker it sets is there,
+        instead of being written again.
+
+        :raises redis.TimeoutError: When the batch wasn't applied, it can be written again.
+        :raises UnconfirmedBatch: When the marker couldn't be read either.
+        """
+        try:
+            pipe.execute()
+        except redis.TimeoutError:
+            try:
+                applied = self.r.get(self.batch_key(device)) == marker.encode()
+            except redis.RedisError as e:
+                raise UnconfirmedBatch(f"Batch of {self.batch_key(device)} timed out, unknown outcome: {e}")
+            if not applied:
+                raise
+
+    def trim_raw(self, pipe, device):
+        """
+        Queue on `pipe` the removal of the raw stream entries older than `raw_retention`.
+        """
+        if self.raw_retention:
+            pipe.xtrim(self.sample_key(device), minid=int((time.time() - self.raw_retention) * 1000),
+                       approximate=True)
+
+    def update_rollups(self, pipe, samples, device):
+        """
+        Fold samples into the open bucket of every rollup tier. A bucket is written to its tier
+        stream, with the bucket start as entry ID, as soon as a sample falls past its end.
+
+        The open buckets are updated on copies, to be applied with `open_rollups.update` once
+        `pipe` has been executed. As `pipe` is a transaction, a failed write is not applied at
+        all, and retrying it later doesn't count samples or write buckets twice.
+
+        :param pipe: Pipeline the writes of the closed buckets are queued on.
+        :param samples: A list of (epoch_seconds, sensor_d, sensor_a) tuples, in time order.
+        :returns: The new open buckets, a dict like `open_rollups`.
+        """
+        updated = {}
+        for tier in self.rollup_tiers:
+            bucket = self.open_rollups.get((device, tier))
+            bucket = None if bucket is None else bucket.copy()
+            for timestamp, sensor_d, sensor_a, *_ in samples:
+                start = int(timestamp // tier) * tier
+                if bucket is None or start > bucket.start:
+                    if bucket is not None:
+                        self.write_rollup(pipe, device, tier, bucket)
+                    bucket = RollupBucket(start)
+                elif start < bucket.start:
+                    continue  # Late sample, its bucket has already been written
+                bucket.add(sensor_d, sensor_a)
+            updated[(device, tier)] = bucket
+        return updated
+
+    def write_rollup(self, pipe, device, tier, bucket):
+        key = self.rollup_key(tier, device)
+        pipe.xadd(key, bucket.fields(), id=f"{bucket.start * 1000}-*")
+        if self.rollup_retention:
+            pipe.xtrim(key, minid=int((time.time() - self.rollup_retention) * 1000), approximate=True)
+
+    def flush_rollups(self):
+        """
+        Write the buckets still open, e.g. before the application exits.
+        """
+        pipe = self.r.pipeline(transaction=False)
+        for (device, tier), bucket in self.open_rollups.items():
+            if bucket is not None:
+                self.write_rollup(pipe, device, tier, bucket)
+        self.open_rollups = {}
+        pipe.execute()
+
+    def key(self, name):
+        """
+        Name of the `name` key in the keyspace of the run.
+        """
+        return self.prefix + name
+
+    def chunk_start(self, timestamp):
+        """
+        Start, in epoch seconds, of the "binary" mode chunk holding a sample taken at `timestamp`.
+        """
+        return int(timestamp // self.chunk_seconds) * self.chunk_seconds
+
+    def chunk_key(self, start, device=None):
+        """
+        Name of the blob holding the records of `device` (defaults to `self.device`) from `start` on.
+        """
+        device = self.device if device is None else device
+        return self.key(f"data_chunk:{start}" if device is None else f"data_chunk:{device}:{start}")
+
+    def chunk_index_key(self, device=None):
+        """
+        Name of the sorted set listing the chunks of `device` (defaults to `self.device`) by start.
+        """
+        device = self.device if device is None else device
+        return self.key("data_chunks" if device is None else f"data_chunks:{device}")
+
+    def chunk_starts(self, first="-inf"):
+        """
+        Starts of the chunks of `self.device` from `first` on, in time order.
+        """
+        return [int(float(start)) for start in self.r.zrangebyscore(self.chunk_index_key(), first, "+inf")]
+
+    def batch_key(self, device=None):
+        """
+        Name of the key holding the marker of the last batch of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        return self.key("data_batch" if device is None else f"data_batch:{device}")
+
+    def counter_key(self, device=None):
+        """
+        Name of the counter of the "hash" mode samples of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        return self.key("data_counter" if device is None else f"data_counter:{device}")
+
+    def hash_key(self, n, device=None):
+        """
+        Name of the hash holding the `n`th sample of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        return self.key(f"data_{n}" if device is None else f"data_sample:{device}:{n}")
+
+    def rollup_key(self, tier, device=None):
+        """
+        Name of the stream holding the `tier` seconds rollups of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        return self.key(f"data_rollup:{tier}" if device is None else f"data_rollup:{tier}:{device}")
+
+    def sample_key(self, device=None):
+        """
+        Name of the stream holding the samples of `device` (defaults to `self.device`).
+        """
+        device = self.device if device is None else device
+        return self.key(self.stream_key if device is None else f"{self.stream_key}:{device}")
+
+    def list_devices(self):
+        """
+        IDs of every controller that logged tagged samples.
+        """
+        return sorted(device.decode() for device in self.r.smembers(self.key("data_devices")))
+
+    def for_device(self, device):
+        """
+        A ValkeyLog with the same settings, bound to another device.
+        """
+        return ValkeyLog(self.host, self.port, self.db, mode=self.mode, stream_key=self.stream_key,
+                         maxlen=self.maxlen, device=device, rollup_tiers=self.rollup_tiers,
+                         raw_retention=self.raw_retention, rollup_retention=self.rollup_retention,
+                         chunk_seconds=self.chunk_seconds, unix_socket_path=self.unix_socket_path,
+                         run_id=self.run_id)
+
+    def for_run(self, run_id):
+        """
+        A ValkeyLog with the same settings, bound to the keyspace of another run.
+        """
+        return ValkeyLog(self.host, self.port, self.db, mode=self.mode, stream_key=self.stream_key,
+                         maxlen=self.maxlen, device=self.device, rollup_tiers=self.rollup_tiers,
+                         raw_retention=self.raw_retention, rollup_retention=self.rollup_retention,
+                         chunk_seconds=self.chunk_seconds, unix_socket_path=self.unix_socket_path,
+                         run_id=run_id)
+
+    def list_runs(self):
+        """
+        IDs of every run with metadata in Valkey, oldest first.
+        """
+        return [run_id.decode() for run_id in self.r.zrange(RUNS_KEY, 0, -1)]
+
+    def save_run_meta(self, meta):
+        """
+        Add or update fields of the metadata of the run (kind, status, start and stop times...).
+
+        :param meta: Dict of str values.
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset(self.key("meta"), mapping=meta)
+        pipe.zadd(RUNS_KEY, {self.run_id: time.time()}, nx=True)
+        pipe.execute()
+
+    def load_run_meta(self):
+        return {field.decode(): value.decode() for field, value in self.r.hgetall(self.key("meta")).items()}
+
+    def fetch_range(self, start=None, end=None, count=None):
+        """
+        Fetch the samples logged in a time window with one XRANGE query.
+
+        :param start: Start of the window as a datetime or epoch-ms, None for the first sample.
+        :param end: End of the window as a datetime or epoch-ms, None for the last sample.
+        :param count: Optional maximum number of samples to return.
+        :returns: A list of (epoch_ms, sensor_d, sensor_a) tuples ordered by time.
+        """
+        if self.mode == "binary":
+            start_ms = None if start is None else int(self.to_stream_id(start, 0))
+            end_ms = None if end is None else int(self.to_stream_id(end, 0))
+            first = "-inf" if start_ms is None else self.chunk_start(start_ms / 1000)
+            samples = []
+            for chunk in self.chunk_starts(first):
+                if end_ms is not None and chunk * 1000 > end_ms:
+                    break
+                records = unpack(self.r.get(self.chunk_key(chunk)) or b"")
+                mask = np.ones(len(records), dtype=bool)
+                if start_ms is not None:
+                    mask &= records['t'] >= start_ms
+                if end_ms is not None:
+                    mask &= records['t'] <= end_ms
+                samples.extend(to_samples(records[mask]))
+                if count is not None and len(samples) >= count:
+                    return samples[:count]
+            return samples
+
+        if self.mode != "stream":
+            raise ValueError("fetch_range requires the 'stream' or 'binary' storage mode")
+
+        entries = self.r.xrange(self.sample_key(), min=self.to_stream_id(start, "-"),
+                                max=self.to_stream_id(end, "+"), count=count)
+        return [self.decode_entry(entry_id, fields) for entry_id, fields in entries]
+
+    def fetch_since(self, cursor=None, start=None, backfill=3600, batch_size=1000):
+        """
+        Fetch only the samples logged after `cursor`, so readers polling every tick
+        don't rescan the whole keyspace.
+
+        :param cursor: Cursor returned by the previous call, None on the first call.
+        :param start: On the first call, ignore samples older than this datetime or epoch-ms.
+        :param backfill: On the first call in "hash" mode, maximum number of recent samples to look at.
+        :param batch_size: Number of HGETALL sent per pipeline in "hash" mode.
+        :returns: A tuple (samples, cursor), samples being a list of (epoch_ms, sensor_d, sensor_a)
+            tuples ordered by time and cursor the value to pass to the next call.
+        """
+        if self.mode == "stream":
+            if cursor is None:
+                entries = self.r.xrange(self.sample_key(), min=self.to_stream_id(start, "-"), max="+")
+            else:
+                entries = self.r.xrange(self.sample_key(), min=f"({cursor}", max="+")
+            if entries:
+                cursor = entries[-1][0].decode()
+            return [self.decode_entry(entry_id, fields) for entry_id, fields in entries], cursor
+
+        if self.mode == "binary":
+            records, cursor = self.fetch_records_since(cursor, start)
+            return to_samples(records), cursor
+
+        counter = int(self.r.get(self.counter_key()) or 0)
+        if cursor is None:
+            cursor = max(0, counter - backfill)
+        elif counter < cursor:
+            # The counter went backwards, the database has been purged since the last call
+            cursor = 0
+
+        start_ms = None if start is None else int(self.to_stream_id(start, 0))
+        samples = []
+        for first in range(cursor + 1, counter + 1, batch_size):
+            for sample in self.fetch_hashes(first, min(first + batch_size, counter + 1)):
+                if start_ms is None or sample[0] >= start_ms:
+                    samples.append(sample)
+        return samples, counter
+
+    def fetch_records_since(self, cursor=None, start=None):
+        """
+        "binary" mode: fetch the records appended after `cursor` as one structured array
+        (fields t, d, a and flags, see utils.Records), decoded without any per-sample work.
+
+        :param cursor: Cursor returned by the previous call, None on the first call.
+        :param start: On the first call, ignore records older than this datetime or epoch-ms.
+        :returns: A tuple (records, cursor), cursor being (chunk start, bytes already read).
+        """
+        start_ms = None
+        if cursor is None:
+            start_ms = None if start is None else int(self.to_stream_id(start, 0))
+            cursor = ("-inf" if start_ms is None else self.chunk_start(start_ms / 1000), 0)
+        chunk, offset = cursor
+
+        starts = self.chunk_starts(chunk)
+        if not starts:
+            return np.empty(0, dtype=RECORD_DTYPE), cursor
+        if starts[0] != chunk:
+            offset = 0  # Starting a new chunk
+        elif self.r.strlen(self.chunk_key(chunk)) < offset:
+            offset = 0  # The chunk shrank, the database has been purged since the last call
+
+        pipe = self.r.pipeline(transaction=False)
+        for index, first in enumerate(starts):
+            pipe.getrange(self.chunk_key(first), offset if index == 0 else 0, -1)
+        blobs = pipe.execute()
+
+        records = np.concatenate([unpack(blob) for blob in blobs])
+        cursor = (starts[-1], (offset if len(starts) == 1 else 0) + len(blobs[-1]))
+        if start_ms is not None:
+            records = records[records['t'] >= start_ms]
+        return records, cursor
+
+    def fetch_hashes(self, first, stop):
+        """
+        Fetch the hashes of the samples `first..stop-1` of the device with one pipelined round
+        trip, skipping the counters whose hash doesn't exist (anymore) or is tagged with another
+        device.
+
+        :returns: A list of (epoch_ms, sensor_d, sensor_a) tuples ordered by counter.
+        """
+        pipe = self.r.pipeline(transaction=False)
+        for n in range(first, stop):
+            pipe.hgetall(self.hash_key(n))
+        device = None if self.device is None else self.device.encode()
+        return [self.decode_hash(data) for data in pipe.execute() if data and data.get(b'device') == device]
+
+    def fetch_rollups_since(self, tier, cursor=None, start=None):
+        """
+        Fetch the `tier` seconds rollup buckets written after `cursor`, like `fetch_since`.
+
+        :param cursor: Cursor returned by the previous call, None on the first call.
+        :param start: On the first call, ignore buckets starting before this datetime or epoch-ms.
+        :returns: A tuple (buckets, cursor), buckets being a list of (start_ms, d_min, d_max,
+            d_mean, d_last, a_min, a_max, a_mean, a_last) tuples ordered by time.
+        """
+        key = self.rollup_key(tier)
+        lower = self.to_stream_id(start, "-") if cursor is None else f"({cursor}"
+        entries = self.r.xrange(key, min=lower, max="+")
+        if entries:
+            cursor = entries[-1][0].decode()
+        return [self.decode_rollup(entry_id, fields) for entry_id, fields in entries], cursor
+
+    def count_samples(self):
+        """
+        Number of samples logged so far (in "hash" mode, an upper bound given by the counter).
+        """
+        if self.mode == "stream":
+            return self.r.xlen(self.sample_key())
+        if self.mode == "binary":
+            pipe = self.r.pipeline(transaction=False)
+            for start in self.chunk_starts():
+                pipe.strlen(self.chunk_key(start))
+            return sum(pipe.execute()) // RECORD_DTYPE.itemsize
+        return int(self.r.get(self.counter_key()) or 0)
+
+    def iter_batches(self, batch_size=1000):
+        """
+        Walk every logged sample in time order, one batch at a time, so a whole run can be
+        read without holding it in memory.
+
+        In "hash" mode the counters of the device are walked in order with pipelined HGETALL, in "stream"
+        mode the stream is paged with XRANGE ... COUNT, in "binary" mode each chunk is read with
+        one GET and decoded at once.
+
+        :param batch_size: Number of samples fetched per round trip.
+        :returns: A generator of lists of (epoch_ms, sensor_d, sensor_a) tuples.
+        """
+        if self.mode == "stream":
+            lower = "-"
+            while True:
+                entries = self.r.xrange(self.sample_key(), min=lower, max="+", count=batch_size)
+                if not entries:
+                    return
+                yield [self.decode_entry(entry_id, fields) for entry_id, fields in entries]
+                lower = f"({entries[-1][0].decode()}"
+
+        if self.mode == "binary":
+            for start in self.chunk_starts():
+                records = unpack(self.r.get(self.chunk_key(start)) or b"")
+                for first in range(0, len(records), batch_size):
+                    yield to_samples(records[first:first + batch_size])
+            return
+
+        counter = self.count_samples()
+        for first in range(1, counter + 1, batch_size):
+            batch = self.fetch_hashes(first, min(first + batch_size, counter + 1))
+            if batch:
+                yield batch
+
+    @staticmethod
+    def encode_value(value):
+        """
+        Encode a sensor value for storage, a failed reading (None) becomes an empty string.
+        """
+        return "" if value is None else repr(float(value))
+
+    @staticmethod
+    def decode_value(raw):
+        """
+        Decode a stored sensor value, missing readings come back as NaN.
         """
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        data = {
-            'timestamp': timestamp,
-            'sensor_a': sensor_a,
-            'sensor_d': sensor_d
-        }
+        if raw is None or raw in (b"", b"None"):
+            return float("nan")
+        return float(raw)
 
-        # Increment a counter to ensure unique keys for each log entry
-        key = self.r.incr("data_counter")
+    @staticmethod
+    def to_stream_id(bound, default):
+        """
+        Convert a datetime or epoch-ms bound into a stream ID usable by XRANGE.
+        """
+        if bound is None:
+            return default
+        if isinstance(bound, datetime.datetime):
+            bound = bound.timestamp() * 1000
+        return str(int(bound))
 
-        # Store the data as a hash in Valkey
-        self.r.hset(f"data_{key}", mapping=data)
+    def decode_entry(self, entry_id, fields):
+        """
+        Turn a raw stream entry into an (epoch_ms, sensor_d, sensor_a) tuple.
+        """
+        timestamp_ms = int(entry_id.split(b"-")[0])
+        return timestamp_ms, self.decode_value(fields.get(b'd')), self.decode_value(fields.get(b'a'))
 
-        print(f"Logged data at key: data_{key}")
+    def decode_rollup(self, entry_id, fields):
+        """
+        Turn a raw rollup entry into a (start_ms, d_min, d_max, d_mean, d_last, a_min, a_max,
+        a_mean, a_last) tuple.
+        """
+        return (int(entry_id.split(b"-")[0]),) + tuple(
+            self.decode_value(fields.get(f'{sensor}{stat}'.encode()))
+            for sensor in ('d', 'a') for stat in ('min', 'max', 'mean', 'last'))
 
+    def decode_hash(self, data):
+        """
+        Turn a raw sample hash into an (epoch_ms, sensor_d, sensor_a) tuple.
+        """
+        # Hashes logged before millisecond timestamps have whole seconds, both are ISO formats
+        timestamp = datetime.datetime.fromisoformat(data[b'timestamp'].decode('utf-8'))
+        return (round(timestamp.timestamp() * 1000), self.decode_value(data.get(b'sensor_d')),
+                self.decode_value(data.get(b'sensor_a')))
+
+    def purge(self, batch_size=1000, progress_callback=None):
+        """
+        Delete every logged sample of the run (with its metadata) without blocking the server.
+
+        Keys are walked incrementally with SCAN and removed in batches with UNLINK, so memory
+        is reclaimed by the server in the background and no single command gets huge.
+
+        :param batch_size: Number of keys requested per SCAN step and removed per UNLINK.
+        :param progress_callback: Optional callable receiving the number of keys removed so far.
+        :returns: The number of keys removed.
+        """
+        removed = 0
+        batch = [self.sample_key()] if self.mode == "stream" else []
+        for key in self.r.scan_iter(match=self.key("data_*"), count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                removed += self.r.unlink(*batch)
+                batch = []
+                if progress_callback:
+                    progress_callback(removed)
+        if batch:
+            removed += self.r.unlink(*batch)
+            if progress_callback:
+                progress_callback(removed)
+        if self.run_id is not None:
+            # Last, a purge failing halfway leaves the run listed, so it's evicted again later
+            removed += self.r.unlink(self.key("meta"))
+            self.r.zrem(RUNS_KEY, self.run_id)
+        return removed
+
+
+class WriteBehindLog:
+    def __init__(self, valkey_log, max_pending=3600, batch_size=50, flush_interval=1.0, policy="drop_oldest"):
+        """
+        Write-behind front of a ValkeyLog: `log` only queues the sample, a background writer
+        flushes the queue in pipelined batches, so Valkey latency never reaches the caller.
+
+        :param valkey_log: ValkeyLog the samples are written to.
+        :param max_pending: Maximum number of samples waiting to be written.
+        :param batch_size: A flush is triggered as soon as this many samples are waiting...
+        :param flush_interval: ...or when the oldest waiting sample is this many seconds old.
+        :param policy: What to do when the queue is full: "drop_oldest" or "drop_newest".
+        """
+        if policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown back-pressure policy: {policy}")
+        self.valkey_log = valkey_log
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closing = False
+        self.dropped = 0  # Samples lost to back-pressure
+        self.written = 0
+        self.last_target = valkey_log  # Log of the last batch written, see writer
+
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+        self.writer_thread.start()
+
+    def log(self, sensor_d, sensor_a, timestamp=None, device=None, state=0):
+        """
+        Queue one sample, never blocks on Valkey.
+
+        :param device: ID of the controller the sample comes from, several controllers can
+            share one WriteBehindLog.
+        :param state: State flags of the controller (see utils.Records), kept in "binary" mode.
+        """
+        with self.condition:
+            if self.closing:
+                return
+            # The target log is taken now, a sample queued before set_target stays in the previous run
+            sample = (time.time() if timestamp is None else timestamp, sensor_d, sensor_a, device, state,
+                      self.valkey_log)
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                metrics.increment("valkey_samples_dropped_total")
+                if self.policy == "drop_newest":
+                    return
+                self.pending.popleft()
+            self.pending.append(sample)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+
+    def set_target(self, valkey_log, timeout=None):
+        """
+        Sends the samples logged from now on to `valkey_log`, e.g. the log of a new run. The
+        samples already queued still go to the previous target, then the writer writes its open
+        rollup buckets, so nothing is written to it afterwards.
+
+        :param timeout: Seconds to wait for the previous target to be complete, None doesn't wait.
+        :returns: False when the previous target wasn't complete in time.
+        """
+        with self.condition:
+            self.valkey_log = valkey_log
+            self.condition.notify_all()
+            if timeout is None:
+                return True
+            # Once closing, close() writes the buckets of the last target itself
+            return self.condition.wait_for(lambda: self.closing or self.last_target is valkey_log, timeout)
+
+    def switch_target(self, target):
+        """
+        Writes the open rollup buckets of the previous target, the samples are in order so it
+        won't get any more, and makes `target` the current one.
+        """
+        try:
+            self.last_target.flush_rollups()
+        except (redis.RedisError, OSError) as e:
+            print(f"Error writing the last rollup buckets: {e}")
+        with self.condition:
+            self.last_target = target
+            self.condition.notify_all()
+
+    def writer(self):
+        """
+        Background loop flushing the queue on a size or time trigger. On close, it drains
+        everything still queued before exiting.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: (self.closing or len(self.pending) >= self.batch_size
+                                                 or self.last_target is not self.valkey_log),
+                                        timeout=self.flush_interval)
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.batch_size))]
+                if not batch and self.closing:
+                    return
+                target = self.valkey_log
+
+            if not batch and target is not self.last_target:
+                # Everything queued for the previous target is written
+                self.switch_target(target)
+                continue
+
+            # One pipelined write per log and device present in the batch
+            by_device = {}
+            for sample in batch:
+                by_device.setdefault((sample[5], sample[3]), []).append(sample)
+            try:
+                for target, device in list(by_device):
+                    if target is not self.last_target:
+                        self.switch_target(target)
+                    with metrics.timer("valkey_write_seconds"):
+                        target.log_many([sample[:3] + sample[4:5] for sample in by_device[(target, device)]],
+                                        device=device)
+                    written = len(by_device.pop((target, device)))
+                    self.written += written
+                    metrics.increment("valkey_samples_written_total", written)
+            except (redis.RedisError, OSError, UnconfirmedBatch) as e:
+                print(f"Error logging data: {e}")
+                metrics.increment("valkey_write_errors_total")
+                unwritten = [sample for samples in by_device.values() for sample in samples]
+                # A failed batch wasn't applied (see log_many) and is retried, unless the server
+                # rejected a command (retrying would fail the same way and block the queue), or
+                # it may have been applied (retrying could duplicate it)
+                if self.closing or isinstance(e, (redis.ResponseError, UnconfirmedBatch)):
+                    self.dropped += len(unwritten)
+                    metrics.increment("valkey_samples_dropped_total", len(unwritten))
+                    continue
+                with self.condition:
+                    # Put the samples back in front, keeping the most recent ones if they don't fit
+                    room = self.max_pending - len(self.pending)
+                    kept = unwritten[-room:] if room > 0 else []
+                    self.dropped += len(unwritten) - len(kept)
+                    metrics.increment("valkey_samples_dropped_total", len(unwritten) - len(kept))
+                    self.pending.extendleft(reversed(kept))
+                time.sleep(self.flush_interval)
+
+    def close(self, timeout=10):
+        """
+        Stop accepting new samples and wait for the queue to be written.
+
+        :returns: True when everything queued has been written (or given up on) in time.
+        """
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.writer_thread.join(timeout)
+        if self.writer_thread.is_alive():
+            return False
+        try:
+            self.last_target.flush_rollups()
+        except redis.RedisError as e:
+            print(f"Error writing the last rollup buckets: {e}")
+        return True